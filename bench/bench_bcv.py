@@ -0,0 +1,33 @@
+# Benchmark del extractor BCV: ruta rápida (regex) vs BeautifulSoup completo.
+# Uso: python bench/bench_bcv.py [páginas.html ...]
+# Sin argumentos usa las páginas guardadas en bench/*.html
+import glob
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sources import extract_bcv_fast, parse_bcv_html
+
+ROUNDS = 200
+
+def main(paths):
+    for path in paths:
+        with open(path, 'rb') as f: content = f.read()
+        fast = extract_bcv_fast(content)
+        # Página rota: el parser completo falla (None para comparar con la ruta rápida)
+        try: full = parse_bcv_html(content)
+        except (AttributeError, ValueError): full = None
+        status = "OK" if fast == full else f"DIFERENTE (rápido={fast} completo={full})"
+        if full is None:
+            print(f"{os.path.basename(path)}: {status} (ambos rechazan la página)" if fast is None else f"{os.path.basename(path)}: {status}")
+            continue
+        t_fast = timeit.timeit(lambda: extract_bcv_fast(content), number=ROUNDS) / ROUNDS
+        t_full = timeit.timeit(lambda: parse_bcv_html(content), number=max(1, ROUNDS // 10)) / max(1, ROUNDS // 10)
+        print(f"{os.path.basename(path)} ({len(content) // 1024} KB): {status}")
+        print(f"  rápido:        {t_fast * 1e6:10.1f} µs")
+        print(f"  BeautifulSoup: {t_full * 1e6:10.1f} µs  (x{t_full / t_fast:.0f})")
+
+if __name__ == "__main__":
+    pages = sys.argv[1:] or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.html")))
+    main(pages)
@@ -0,0 +1,47 @@
+# PriceHistory: estadísticas incrementales vs recálculo ingenuo, y costo del append.
+# Uso: python bench/bench_history.py
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from caches import PriceHistory
+
+# (capacidad, ventanas, paso entre ticks): incluye anillos más cortos que la ventana
+CASES = [(20, (1000,), 10), (750, (3600, 21600, 86400), 120), (50, (300, 3600), 7)]
+TICKS = 3000
+ROUNDS = 100000
+
+def naive(ref, capacity, window, now):
+    points = [p for t, p in ref[-capacity:] if t >= now - window]
+    return {"samples": len(points), "min": min(points), "max": max(points), "mean": sum(points) / len(points),
+            "change": (points[-1] - points[0]) / points[0] * 100}
+
+def check(capacity, windows, step):
+    history, ref, errors = PriceHistory(capacity, windows), [], 0
+    for k in range(TICKS):
+        ts = 1_000_000.0 + k * step + random.uniform(0, step / 2)
+        price = 500 + random.uniform(-10, 10)
+        history.append(ts, price)
+        ref.append((ts, price))
+        for window in windows:
+            got, want = history.window(window), naive(ref, capacity, window, ts)
+            if got["samples"] != want["samples"] or any(abs(got[key] - want[key]) > 1e-6 for key in ("min", "max", "mean", "change")):
+                errors += 1
+    return errors
+
+def main():
+    failed = False
+    for capacity, windows, step in CASES:
+        errors = check(capacity, windows, step)
+        failed |= bool(errors)
+        print(f"cap={capacity} ventanas={windows} paso={step}s: {'OK' if not errors else f'{errors} DIFERENTES'}")
+    history = PriceHistory(750)
+    counter = iter(range(10 ** 9))
+    t = timeit.timeit(lambda: history.append(next(counter) * 120.0, 500.0), number=ROUNDS) / ROUNDS
+    print(f"append: {t * 1e6:.1f} µs")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
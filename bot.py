@@ -1,16 +1,21 @@
 import os
 import logging
-import requests
-import psycopg2 
+from time import perf_counter
+STARTUP_T0 = perf_counter()   # Mide el arranque desde antes de los imports
+from db import get_cursor, close_pool, WriteBehindBuffer, BROADCAST_CHANNEL
+from caches import UserCache, AlertIndex, VoteTally, DailyCounter, Leaderboard, PriceHistory
+from migrations import run_migrations, LATEST_VERSION
+from partitions import compact_storage
+from charts import ChartCache, render_price_chart, render_stats_chart, shutdown_renderer
+from snapshot import save_snapshot, load_snapshot
+from sources import collect_binance, start_binance_collect, start_bcv_fetch, tick_deadline, until_deadline, close_sessions, source_health, MAIN_PAY_TYPE
 import asyncio
-import io 
+import hashlib
+from collections import namedtuple
+from functools import lru_cache
 import random 
-import matplotlib
-matplotlib.use('Agg') 
-import matplotlib.pyplot as plt
-from bs4 import BeautifulSoup 
-import urllib3
 from urllib.parse import quote
+from html import escape as html_escape
 from datetime import datetime, time, timedelta
 import pytz 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatMember
@@ -27,9 +32,6 @@ from telegram.ext import (
     ContextTypes
 )
 
-# Silenciar advertencias SSL
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
 # Configuración Logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -42,18 +44,12 @@ ADMIN_ID = int(os.getenv("ADMIN_ID", "533888411"))
 
 # --- CONFIGURACIÓN ---
 UPDATE_INTERVAL = 120 
+PRICE_STALE_AFTER = UPDATE_INTERVAL * 3   # Sin precio nuevo por más de esto: se muestra la edad
+STATS_TTL = 60   # Segundos que se reutiliza el snapshot de /stats
 TIMEZONE = pytz.timezone('America/Caracas') 
-FILTER_MIN_USD = 20
-MAX_HISTORY_POINTS = 200
-
-# Lista Anti-Ban
-USER_AGENTS = [
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15",
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/115.0",
-    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36",
-    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1"
-]
+HISTORY_WINDOWS = (3600, 21600, 86400)   # 1h, 6h, 24h
+MAX_HISTORY_POINTS = HISTORY_WINDOWS[-1] // UPDATE_INTERVAL + 30   # 24h de ticks y algo de margen
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300"))  # Segundos sin reescribir last_active
 
 # Links
 LINK_CANAL = "https://t.me/tasabinance"
@@ -78,9 +74,33 @@ MARKET_DATA = {
     "price": None, 
     "bcv": {'usd': None, 'eur': None},   
     "last_updated": "Esperando...",
-    "history": [] 
+    "history": PriceHistory(MAX_HISTORY_POINTS, HISTORY_WINDOWS),
+    "stale": False,   # True mientras se sirve lo restaurado al arrancar (hasta el primer tick)
+    "price_at": None  # Epoch del último precio Binance bueno
 }
-GRAPH_CACHE = {"date": None, "photo_id": None}
+# Gráficos renderizados: PNG + file_id de Telegram por nombre, invalidados al cambiar los datos
+GRAPH_CACHE = ChartCache()
+CHART_REFRESH_INTERVAL = 600   # Pre-render del gráfico público como mucho cada 10 min
+CHART_WARM_CHAT_ID = os.getenv("CHART_WARM_CHAT_ID")   # Chat (p. ej. canal privado) donde subirlo para tener el file_id
+
+# Logs con escritura diferida (se insertan en bloque cada LOG_FLUSH_INTERVAL)
+LOG_FLUSH_INTERVAL = 2.0
+COUNTER_PERSIST_INTERVAL = 60
+# Cada lote actualiza también el acumulado por comando (command_stats) en la misma sentencia
+ACTIVITY_SINK = WriteBehindBuffer("activity_logs", """
+    WITH rows AS (
+        INSERT INTO activity_logs (user_id, command, created_at) VALUES %s RETURNING command
+    )
+    INSERT INTO command_stats (command, count)
+    SELECT command, COUNT(*) FROM rows WHERE command IS NOT NULL GROUP BY command
+    ON CONFLICT (command) DO UPDATE SET count = command_stats.count + EXCLUDED.count
+""", flush_interval=LOG_FLUSH_INTERVAL)
+CALC_SINK = WriteBehindBuffer("calc_logs", "INSERT INTO calc_logs (user_id, amount, currency_type, result, created_at) VALUES %s", flush_interval=LOG_FLUSH_INTERVAL)
+USER_CACHE = UserCache(ttl=USER_CACHE_TTL)
+ALERT_INDEX = AlertIndex()
+VOTE_TALLY = VoteTally()
+REQUEST_COUNTER = DailyCounter()
+LEADERBOARD = Leaderboard()
 
 # ==============================================================================
 #  BASE DE DATOS
@@ -90,163 +110,45 @@ def init_db():
         logging.warning("⚠️ Sin DATABASE_URL. Usando RAM temporal.")
         return
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        # Tablas
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                first_name TEXT,
-                referral_count INTEGER DEFAULT 0,
-                referred_by BIGINT,
-                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                status TEXT DEFAULT 'active',
-                source TEXT 
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS alerts (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                target_price FLOAT,
-                condition TEXT, 
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS activity_logs (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                command TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS daily_stats (
-                date DATE PRIMARY KEY,
-                price_sum FLOAT DEFAULT 0,
-                count INTEGER DEFAULT 0,
-                bcv_price FLOAT DEFAULT 0
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS price_ticks (
-                id SERIAL PRIMARY KEY,
-                price_binance FLOAT,
-                price_bcv FLOAT,
-                recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                price_sell FLOAT,
-                spread_pct FLOAT
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS calc_logs (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT,
-                amount FLOAT,
-                currency_type TEXT,
-                result FLOAT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS daily_votes (
-                user_id BIGINT,
-                vote_date DATE,
-                vote_type TEXT, 
-                PRIMARY KEY (user_id, vote_date)
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS broadcast_queue (
-                id SERIAL PRIMARY KEY,
-                message TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # Tabla Arbitraje (V49)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS arbitrage_data (
-                id SERIAL PRIMARY KEY,
-                recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                buy_pm FLOAT,
-                sell_pm FLOAT,
-                buy_banesco FLOAT,
-                buy_mercantil FLOAT,
-                buy_provincial FLOAT,
-                spread_pct FLOAT
-            )
-        """)
-
-        conn.commit()
-        cur.close()
-        conn.close()
-        migrate_db()
+        applied = run_migrations()
+        if applied: logging.info(f"🗄️ Esquema en v{LATEST_VERSION} ({len(applied)} pasos, {sum(step[2] for step in applied):.2f}s)")
     except Exception as e:
         logging.error(f"❌ Error BD Init: {e}")
 
-def migrate_db():
-    if not DATABASE_URL: return
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        try:
-            # Migraciones Acumuladas
-            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS first_name TEXT;")
-            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_count INTEGER DEFAULT 0;")
-            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referred_by BIGINT;")
-            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP;")
-            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'active';")
-            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS source TEXT;")
-            
-            cur.execute("ALTER TABLE daily_stats ADD COLUMN IF NOT EXISTS bcv_price FLOAT DEFAULT 0;")
-            
-            cur.execute("ALTER TABLE price_ticks ADD COLUMN IF NOT EXISTS price_sell FLOAT;")
-            cur.execute("ALTER TABLE price_ticks ADD COLUMN IF NOT EXISTS spread_pct FLOAT;")
-            
-            cur.execute("ALTER TABLE arbitrage_data ADD COLUMN IF NOT EXISTS spread_pct FLOAT;")
-            
-            conn.commit()
-        except Exception: conn.rollback()
-        finally:
-            cur.close()
-            conn.close()
-    except Exception: pass
-
 def track_user(user, referrer_id=None, source=None):
     if not DATABASE_URL: return 
     user_id = user.id
     first_name = user.first_name[:50] if user.first_name else "Usuario"
+    # Visto hace poco: last_active ya está al día, no tocar la BD
+    if USER_CACHE.is_fresh(user_id, first_name): return
     now = datetime.now()
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE user_id = %s", (user_id,))
-        exists = cur.fetchone()
-        if not exists:
-            valid_referrer = False
-            final_referrer = None
-            if referrer_id and referrer_id != user_id:
-                cur.execute("SELECT user_id FROM users WHERE user_id = %s", (referrer_id,))
-                if cur.fetchone(): 
-                    valid_referrer = True
-                    final_referrer = referrer_id
-
+        with get_cursor() as cur:
+            # Alta + crédito al referido (solo si el usuario es nuevo) en una sola sentencia
             cur.execute("""
-                INSERT INTO users (user_id, first_name, referred_by, last_active, status, source) 
-                VALUES (%s, %s, %s, %s, 'active', %s)
-            """, (user_id, first_name, final_referrer, now, source))
-            
-            if valid_referrer:
-                cur.execute("UPDATE users SET referral_count = referral_count + 1 WHERE user_id = %s", (final_referrer,))
-        else:
-            cur.execute("UPDATE users SET first_name = %s, last_active = %s, status = 'active' WHERE user_id = %s", (first_name, now, user_id))
-        conn.commit()
-        cur.close()
-        conn.close()
+                WITH ref AS (
+                    SELECT user_id FROM users WHERE user_id = %(ref)s AND user_id <> %(uid)s
+                ), upsert AS (
+                    INSERT INTO users (user_id, first_name, referred_by, last_active, status, source)
+                    VALUES (%(uid)s, %(name)s, (SELECT user_id FROM ref), %(now)s, 'active', %(source)s)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        first_name = EXCLUDED.first_name,
+                        last_active = EXCLUDED.last_active,
+                        status = 'active'
+                    RETURNING (xmax = 0) AS inserted, referred_by
+                ), credit AS (
+                    UPDATE users SET referral_count = referral_count + 1
+                    WHERE user_id = (SELECT referred_by FROM upsert WHERE inserted)
+                    RETURNING user_id, first_name, referral_count
+                )
+                SELECT (SELECT inserted FROM upsert), credit.user_id, credit.first_name, credit.referral_count
+                FROM (SELECT 1) one LEFT JOIN credit ON TRUE
+            """, {"uid": user_id, "name": first_name, "ref": referrer_id, "now": now, "source": source})
+            _, credited_id, credited_name, credited_count = cur.fetchone()
+        USER_CACHE.mark(user_id, first_name)
+        # Mantener el ranking en memoria sin volver a leer la tabla
+        if credited_id: LEADERBOARD.update(credited_id, credited_name, credited_count)
+        LEADERBOARD.rename(user_id, first_name)
     except Exception as e: logging.error(f"Error track_user: {e}")
 
 async def track_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -258,46 +160,27 @@ async def track_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYP
         db_status = 'blocked'
     elif new_status == ChatMember.MEMBER:
         db_status = 'active'
+    USER_CACHE.forget(user_id)
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("UPDATE users SET status = %s WHERE user_id = %s", (db_status, user_id))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_cursor() as cur:
+            cur.execute("UPDATE users SET status = %s WHERE user_id = %s", (db_status, user_id))
     except Exception as e: logging.error(f"Error tracking chat member: {e}")
 
 def log_activity(user_id, command):
     if not DATABASE_URL: return
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("INSERT INTO activity_logs (user_id, command) VALUES (%s, %s)", (user_id, command))
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e: logging.error(f"Error log_activity: {e}")
+    REQUEST_COUNTER.incr(datetime.now(TIMEZONE).date())
+    ACTIVITY_SINK.put((user_id, command, datetime.now()))
 
 def log_calc(user_id, amount, currency, result):
     if not DATABASE_URL: return
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("INSERT INTO calc_logs (user_id, amount, currency_type, result) VALUES (%s, %s, %s, %s)", (user_id, amount, currency, result))
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e: logging.error(f"Error log_calc: {e}")
+    CALC_SINK.put((user_id, amount, currency, result, datetime.now()))
 
 def get_user_loyalty(user_id):
     if not DATABASE_URL: return (0, 0)
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT joined_at, referral_count FROM users WHERE user_id = %s", (user_id,))
-        res = cur.fetchone()
-        cur.close()
-        conn.close()
+        with get_cursor() as cur:
+            cur.execute("SELECT joined_at, referral_count FROM users WHERE user_id = %s", (user_id,))
+            res = cur.fetchone()
         if res:
             days = (datetime.now() - res[0]).days
             refs = res[1]
@@ -305,198 +188,233 @@ def get_user_loyalty(user_id):
         return (0, 0)
     except Exception: return (0, 0)
 
+def seed_request_count():
+    # Una sola vez al arrancar: lo ya guardado hoy o, si es más, lo que hay en activity_logs
+    if not DATABASE_URL: return
+    local_midnight = datetime.now(TIMEZONE).replace(hour=0, minute=0, second=0, microsecond=0)
+    today = local_midnight.date()
+    since = local_midnight.astimezone().replace(tzinfo=None)  # created_at se guarda en hora local del servidor
+    try:
+        with get_cursor() as cur:
+            cur.execute("""
+                SELECT GREATEST(
+                    (SELECT count FROM daily_requests WHERE day = %s),
+                    (SELECT COUNT(*) FROM activity_logs WHERE created_at >= %s)
+                )
+            """, (today, since))
+            count = cur.fetchone()[0] or 0
+        REQUEST_COUNTER.seed(today, count)
+        logging.info(f"👁 Consultas hoy: {count}")
+    except Exception as e: logging.error(f"Error sembrando contador: {e}")
+
+def persist_request_count():
+    if not DATABASE_URL: return
+    rows = REQUEST_COUNTER.drain()
+    if not rows: return
+    try:
+        with get_cursor() as cur:
+            for day, count in rows:
+                cur.execute("""
+                    INSERT INTO daily_requests (day, count) VALUES (%s, %s)
+                    ON CONFLICT (day) DO UPDATE SET count = GREATEST(daily_requests.count, EXCLUDED.count)
+                """, (day, count))
+    except Exception as e: logging.error(f"Error guardando contador: {e}")
+
 def get_daily_requests_count():
     if not DATABASE_URL: return 0
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM activity_logs WHERE created_at >= CURRENT_DATE")
-        count = cur.fetchone()[0]
-        cur.close()
-        conn.close()
-        return count
-    except Exception: return 0
+    return REQUEST_COUNTER.value(datetime.now(TIMEZONE).date())
 
 def get_yesterday_close():
     if not DATABASE_URL: return None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT (price_sum / NULLIF(count, 0)) FROM daily_stats WHERE date = CURRENT_DATE - 1")
-        res = cur.fetchone()
-        cur.close()
-        conn.close()
+        with get_cursor() as cur:
+            cur.execute("SELECT (price_sum / NULLIF(count, 0)) FROM daily_stats WHERE date = CURRENT_DATE - 1")
+            res = cur.fetchone()
         return res[0] if res else None
     except Exception: return None
 
+def load_votes(day=None):
+    # Carga los votos del día (al arrancar y al cambiar de día en TIMEZONE)
+    if not DATABASE_URL: return
+    day = day or datetime.now(TIMEZONE).date()
+    try:
+        with get_cursor() as cur:
+            cur.execute("SELECT user_id, vote_type FROM daily_votes WHERE vote_date = %s", (day,))
+            rows = cur.fetchall()
+        VOTE_TALLY.load(day, rows)
+        logging.info(f"🗳️ Votos del {day}: {len(rows)}")
+    except Exception as e: logging.error(f"Error cargando votos: {e}")
+
+VOTES_RELOAD = {"task": None, "at": 0.0}
+VOTES_RELOAD_RETRY = 30   # Segundos entre recargas si la BD falla
+
+def _schedule_votes_reload(day):
+    # Desde el loop: recarga en un hilo, una a la vez y sin reintentar en cada render
+    task = VOTES_RELOAD["task"]
+    if (task and not task.done()) or perf_counter() - VOTES_RELOAD["at"] < VOTES_RELOAD_RETRY: return
+    try: loop = asyncio.get_running_loop()
+    except RuntimeError: return
+    VOTES_RELOAD["at"] = perf_counter()
+    VOTES_RELOAD["task"] = loop.create_task(asyncio.to_thread(load_votes, day))
+
+def _votes_today(load=False):
+    # load=True solo fuera del loop (hilos); los handlers nunca tocan la BD: sin cargar = sin votos
+    today = datetime.now(TIMEZONE).date()
+    if VOTE_TALLY.is_for(today): return True
+    if load: load_votes(today)
+    else: _schedule_votes_reload(today)
+    return VOTE_TALLY.is_for(today)
+
 def cast_vote(user_id, vote_type):
     if not DATABASE_URL: return False
     today = datetime.now(TIMEZONE).date()
+    if _votes_today(load=True) and VOTE_TALLY.has_voted(user_id): return False
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO daily_votes (user_id, vote_date, vote_type)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (user_id, vote_date) DO NOTHING
-        """, (user_id, today, vote_type))
-        rows = cur.rowcount
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_cursor() as cur:
+            cur.execute("""
+                INSERT INTO daily_votes (user_id, vote_date, vote_type)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (user_id, vote_date) DO NOTHING
+            """, (user_id, today, vote_type))
+            rows = cur.rowcount
+        if rows > 0 and VOTE_TALLY.is_for(today): VOTE_TALLY.add(user_id, vote_type)
         return rows > 0
     except Exception: return False
 
+async def rollover_task(context: ContextTypes.DEFAULT_TYPE):
+    # Medianoche en TIMEZONE: cerrar el contador de ayer y cargar el día nuevo fuera del camino de los handlers
+    REQUEST_COUNTER.incr(datetime.now(TIMEZONE).date(), 0)
+    await asyncio.to_thread(persist_request_count)
+    await asyncio.to_thread(load_votes)
+
+async def persist_counters_task(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(persist_request_count)
+
+async def compact_storage_task(context: ContextTypes.DEFAULT_TYPE):
+    # Madrugada: agregados diarios/horarios y borrado de particiones vencidas (RAW_RETENTION_DAYS)
+    try: await asyncio.to_thread(compact_storage)
+    except Exception as e: logging.error(f"Error compactación: {e}")
+
 def get_vote_results():
-    if not DATABASE_URL: return (0, 0)
-    today = datetime.now(TIMEZONE).date()
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT vote_type, COUNT(*) FROM daily_votes WHERE vote_date = %s GROUP BY vote_type", (today,))
-        results = dict(cur.fetchall())
-        up = results.get('UP', 0)
-        down = results.get('DOWN', 0)
-        cur.close()
-        conn.close()
-        return (up, down)
-    except Exception: return (0, 0)
+    if not DATABASE_URL or not _votes_today(): return (0, 0)
+    return VOTE_TALLY.results()
 
 def has_user_voted(user_id):
-    if not DATABASE_URL: return False
-    today = datetime.now(TIMEZONE).date()
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM daily_votes WHERE user_id = %s AND vote_date = %s", (user_id, today))
-        voted = cur.fetchone() is not None
-        cur.close()
-        conn.close()
-        return voted
-    except Exception: return False
+    if not DATABASE_URL or not _votes_today(): return False
+    return VOTE_TALLY.has_voted(user_id)
 
 # ==============================================================================
 #  ANALÍTICAS VISUALES (DASHBOARD)
 # ==============================================================================
-def generate_stats_chart():
+STATS_CACHE = {"at": 0.0, "data": None}
+
+def get_stats_snapshot():
+    # Todo /stats (texto y gráfico) sale de una sola consulta, reutilizada STATS_TTL segundos
     if not DATABASE_URL: return None
-    buf = io.BytesIO()
+    now = datetime.now().timestamp()
+    if STATS_CACHE["data"] and now - STATS_CACHE["at"] < STATS_TTL: return STATS_CACHE["data"]
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT TO_CHAR(joined_at, 'MM-DD'), COUNT(*) 
-            FROM users WHERE joined_at >= NOW() - INTERVAL '7 DAYS'
-            GROUP BY 1 ORDER BY 1
-        """)
-        growth_data = cur.fetchall()
-        cur.execute("""
-            SELECT command, COUNT(*) FROM activity_logs 
-            GROUP BY command ORDER BY 2 DESC LIMIT 5
-        """)
-        cmd_data = cur.fetchall()
-        plt.style.use('dark_background')
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10, 5))
-        bg_color = '#212121'
-        fig.patch.set_facecolor(bg_color)
-        ax1.set_facecolor(bg_color)
-        ax2.set_facecolor(bg_color)
-        if growth_data:
-            dates = [row[0] for row in growth_data]
-            counts = [row[1] for row in growth_data]
-            bars = ax1.bar(dates, counts, color='#F3BA2F') 
-            ax1.set_title('Nuevos Usuarios (7 Días)', color='white', fontsize=12)
-            ax1.bar_label(bars, color='white')
-        else: ax1.text(0.5, 0.5, "Sin datos", ha='center', color='gray')
-        if cmd_data:
-            labels = [row[0] for row in cmd_data]
-            sizes = [row[1] for row in cmd_data]
-            ax2.pie(sizes, labels=labels, autopct='%1.1f%%', startangle=90, textprops={'color':"white"})
-            ax2.set_title('Comandos Favoritos', color='white', fontsize=12)
-        else: ax2.text(0.5, 0.5, "Esperando data", ha='center', color='gray')
-        plt.tight_layout()
-        plt.savefig(buf, format='png', facecolor=bg_color)
-        buf.seek(0)
-        plt.close()
-        cur.close()
-        conn.close()
-        return buf
-    except Exception: return None
+        with get_cursor() as cur:
+            cur.execute("""
+                SELECT
+                    COUNT(*),
+                    COUNT(*) FILTER (WHERE status = 'blocked'),
+                    COUNT(*) FILTER (WHERE joined_at >= CURRENT_DATE),
+                    COUNT(*) FILTER (WHERE last_active >= NOW() - INTERVAL '24 HOURS'),
+                    COUNT(*) FILTER (WHERE referred_by IS NOT NULL),
+                    (SELECT COUNT(*) FROM alerts),
+                    (SELECT COALESCE(json_agg(json_build_array(source, n)), '[]') FROM (
+                        SELECT source, COUNT(*) AS n FROM users WHERE source IS NOT NULL
+                        GROUP BY source ORDER BY 2 DESC LIMIT 3) s),
+                    (SELECT COALESCE(json_agg(json_build_array(day, n) ORDER BY day), '[]') FROM (
+                        SELECT TO_CHAR(joined_at, 'MM-DD') AS day, COUNT(*) AS n FROM users
+                        WHERE joined_at >= NOW() - INTERVAL '7 DAYS' GROUP BY 1) g),
+                    (SELECT COALESCE(json_agg(json_build_array(command, count) ORDER BY count DESC), '[]') FROM command_stats),
+                    -- Agregados de la compactación (días cerrados): sobreviven a la retención de los logs crudos
+                    (SELECT COALESCE(json_agg(json_build_array(command, n) ORDER BY n DESC), '[]') FROM (
+                        SELECT command, SUM(count) AS n FROM activity_daily
+                        WHERE day >= CURRENT_DATE - 7 GROUP BY command ORDER BY 2 DESC LIMIT 5) w),
+                    (SELECT COALESCE(json_agg(json_build_array(currency_type, n, amount) ORDER BY n DESC), '[]') FROM (
+                        SELECT currency_type, SUM(count) AS n, SUM(amount_sum) AS amount FROM calc_daily
+                        WHERE day >= CURRENT_DATE - 7 GROUP BY currency_type) c),
+                    (SELECT json_build_array(SUM(spread_pct_avg * samples) / NULLIF(SUM(samples), 0), MIN(buy_pm_min), MAX(buy_pm_max))
+                        FROM arbitrage_hourly WHERE hour >= CURRENT_DATE - 7)
+                FROM users
+            """)
+            total, blocked, new_today, active_24h, total_referrals, active_alerts, sources, growth, commands, commands_7d, calcs_7d, market_7d = cur.fetchone()
+    except Exception as e:
+        logging.error(f"Error snapshot stats: {e}")
+        return STATS_CACHE["data"]
+    data = {
+        "total": total, "blocked": blocked, "new_today": new_today, "active_24h": active_24h,
+        "total_referrals": total_referrals, "active_alerts": active_alerts,
+        "requests_today": get_daily_requests_count(),
+        "top_sources": [tuple(row) for row in sources],
+        "growth": tuple(tuple(row) for row in growth),
+        "top_commands": [tuple(row) for row in commands],
+        "commands_7d": [tuple(row) for row in commands_7d],
+        "calcs_7d": [tuple(row) for row in calcs_7d],
+        "market_7d": tuple(market_7d),
+    }
+    STATS_CACHE["at"] = now
+    STATS_CACHE["data"] = data
+    return data
 
 # --- GRÁFICO VERTICAL ---
-def generate_public_price_chart():
-    # (Código V44 - Se mantiene igual)
+def get_public_chart_data():
+    # Lo que se dibuja, ya redondeado: sirve también de huella para la caché.
+    # Solo días cerrados: el promedio de hoy cambia en cada tick y obligaría a redibujar
+    # y volver a subir el gráfico (perdiendo el file_id) todo el día
     if not DATABASE_URL: return None
-    buf = io.BytesIO()
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT date, (price_sum / NULLIF(count, 0)) as avg_binance, bcv_price FROM daily_stats ORDER BY date DESC LIMIT 7")
-        data = cur.fetchall()
         today_date = datetime.now(TIMEZONE).date()
-        current_binance = MARKET_DATA["price"]
-        current_bcv = MARKET_DATA["bcv"]["usd"] if MARKET_DATA["bcv"] else 0
-        has_today = any(d[0] == today_date for d in data)
-        if not has_today and current_binance: data.insert(0, (today_date, current_binance, current_bcv))
+        with get_cursor() as cur:
+            cur.execute("SELECT date, (price_sum / NULLIF(count, 0)) as avg_binance, bcv_price FROM daily_stats WHERE date < %s ORDER BY date DESC LIMIT 7", (today_date,))
+            data = cur.fetchall()
+        data = [d for d in data if d[1] is not None]
         data.sort(key=lambda x: x[0]) 
-        dates = [d[0].strftime('%d/%m') for d in data]
-        prices_bin = [d[1] for d in data]
-        prices_bcv = [d[2] if d[2] > 0 else None for d in data]
-        if not prices_bin: return None
-        plt.style.use('dark_background')
-        fig, ax = plt.subplots(figsize=(6, 8)) 
-        bg_color = '#1e1e1e'
-        fig.patch.set_facecolor(bg_color); ax.set_facecolor(bg_color)
-        ax.plot(dates, prices_bin, color='#F3BA2F', marker='o', linewidth=4, label="Binance")
-        ax.plot(dates, prices_bcv, color='#2979FF', marker='s', linewidth=2, linestyle='--', label="BCV")
-        ax.set_title('TASA BINANCE VZLA', color='#F3BA2F', fontsize=18, fontweight='bold', pad=25)
-        ax.legend(loc="upper center", bbox_to_anchor=(0.5, 1.05), ncol=2, frameon=False)
-        for i, price in enumerate(prices_bin):
-            ax.annotate(f"{price:.2f}", (dates[i], prices_bin[i]), textcoords="offset points", xytext=(0,15), ha='center', color='white', fontsize=11, fontweight='bold')
-        for i, price in enumerate(prices_bcv):
-            if price: ax.annotate(f"{price:.2f}", (dates[i], prices_bcv[i]), textcoords="offset points", xytext=(0,-20), ha='center', color='#2979FF', fontsize=10, fontweight='bold')
-        fig.text(0.5, 0.5, '@tasabinance_bot', fontsize=28, color='white', ha='center', va='center', alpha=0.08, rotation=45, fontweight='bold')
-        plt.tight_layout()
-        plt.savefig(buf, format='png', facecolor=bg_color, dpi=100)
-        buf.seek(0); plt.close(); cur.close(); conn.close()
-        return buf
+        return tuple((d[0].strftime('%d/%m'), round(d[1], 2), round(d[2], 2) if d[2] and d[2] > 0 else None) for d in data) or None
     except Exception: return None
 
+async def get_public_chart(max_age=None):
+    # Entrada de caché (png, file_id); max_age evita consultar la BD si la última es reciente
+    entry = GRAPH_CACHE.get("price")
+    if entry and max_age is not None and datetime.now().timestamp() - entry["rendered_at"] < max_age: return entry
+    data = await asyncio.to_thread(get_public_chart_data)
+    if not data: return entry
+    return await GRAPH_CACHE.render("price", data, render_price_chart, data)
+
+async def prerender_public_chart(bot):
+    # Tras guardar daily_stats: render en segundo plano y subida para calentar el file_id
+    try:
+        entry = await get_public_chart(max_age=CHART_REFRESH_INTERVAL)
+        if not entry or entry["file_id"] or not CHART_WARM_CHAT_ID: return
+        msg = await bot.send_photo(chat_id=CHART_WARM_CHAT_ID, photo=entry["png"], disable_notification=True)
+        if msg.photo: GRAPH_CACHE.set_file_id("price", entry["fingerprint"], msg.photo[-1].file_id)
+    except Exception as e: logging.error(f"Error pre-render gráfico: {e}")
+
 # 🔥 FIX STATS V50: REPORTE COMPLETO CON CONCATENACIÓN ROBUSTA 🔥
-def get_detailed_report_text():
+def get_detailed_report_text(snapshot=None):
     if not DATABASE_URL: return "⚠️ Error DB"
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
+        snapshot = snapshot or get_stats_snapshot()
+        if not snapshot: return "Error calculando métricas"
         # 1. KPI Principales
-        cur.execute("SELECT COUNT(*) FROM users")
-        total = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM users WHERE status = 'blocked'")
-        blocked = cur.fetchone()[0]
+        total = snapshot["total"]
+        blocked = snapshot["blocked"]
         active_real = total - blocked
         churn_rate = (blocked / total * 100) if total > 0 else 0
         
         # 2. Actividad Reciente
-        cur.execute("SELECT COUNT(*) FROM users WHERE joined_at >= CURRENT_DATE")
-        new_today = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM users WHERE last_active >= NOW() - INTERVAL '24 HOURS'")
-        active_24h = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM alerts")
-        active_alerts = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM activity_logs WHERE created_at >= CURRENT_DATE")
-        requests_today = cur.fetchone()[0]
+        new_today = snapshot["new_today"]
+        active_24h = snapshot["active_24h"]
+        active_alerts = snapshot["active_alerts"]
+        requests_today = snapshot["requests_today"]
         
         # 3. Listas Top (Concatenación Segura)
-        cur.execute("SELECT source, COUNT(*) FROM users WHERE source IS NOT NULL GROUP BY source ORDER BY 2 DESC LIMIT 3")
-        top_sources = cur.fetchall()
-        cur.execute("SELECT command, COUNT(*) FROM activity_logs GROUP BY command ORDER BY 2 DESC")
-        top_commands = cur.fetchall()
-        cur.execute("SELECT COUNT(*) FROM users WHERE referred_by IS NOT NULL")
-        total_referrals = cur.fetchone()[0]
-        
-        cur.close()
-        conn.close()
+        top_sources = snapshot["top_sources"]
+        top_commands = snapshot["top_commands"]
+        total_referrals = snapshot["total_referrals"]
         
         # Construcción del Mensaje
         text = (
@@ -526,180 +444,222 @@ def get_detailed_report_text():
             for cmd, cnt in top_commands:
                 text += f"• {cmd}: {cnt}\n"
 
+        # Bloque 7 días (agregados diarios/horarios)
+        if snapshot["commands_7d"]:
+            text += "\n📆 <b>Comandos (7 días):</b>\n"
+            for cmd, cnt in snapshot["commands_7d"]:
+                text += f"• {cmd or '-'}: {cnt}\n"
+        if snapshot["calcs_7d"]:
+            text += "\n🧮 <b>Calculadora (7 días):</b>\n"
+            for currency, cnt, amount in snapshot["calcs_7d"]:
+                text += f"• {currency or '-'}: {cnt} ({amount:,.0f})\n"
+        spread, low, high = snapshot["market_7d"]
+        if spread is not None:
+            text += f"\n💱 <b>Spread medio (7 días):</b> {spread:.2f}%\n↕️ <b>Rango:</b> {low:,.2f} - {high:,.2f} Bs\n"
+
         text += f"\n<i>Sistema Operativo V50 (Debug+Fix).</i> ✅"
         return text
     except Exception as e: 
         logging.error(f"Error detailed report: {e}")
         return f"Error calculando métricas: {e}"
 
+def load_leaderboard():
+    if not DATABASE_URL: return
+    try:
+        with get_cursor() as cur:
+            cur.execute("SELECT user_id, first_name, referral_count FROM users WHERE referral_count > 0")
+            LEADERBOARD.load(cur.fetchall())
+        logging.info(f"🏆 Ranking en memoria: {len(LEADERBOARD)} referidores")
+    except Exception as e: logging.error(f"Error cargando ranking: {e}")
+
 def get_referral_stats(user_id):
     if not DATABASE_URL: return (0, 0, [])
+    if LEADERBOARD.loaded:
+        count = LEADERBOARD.score(user_id)
+        return (count, LEADERBOARD.rank(count), LEADERBOARD.top(3))
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT referral_count FROM users WHERE user_id = %s", (user_id,))
-        res = cur.fetchone()
-        my_count = res[0] if res else 0
-        cur.execute("SELECT COUNT(*) + 1 FROM users WHERE referral_count > %s", (my_count,))
-        my_rank = cur.fetchone()[0]
-        cur.execute("SELECT first_name, referral_count FROM users ORDER BY referral_count DESC LIMIT 3")
-        top_3 = cur.fetchall()
-        cur.close()
-        conn.close()
+        with get_cursor() as cur:
+            cur.execute("SELECT referral_count FROM users WHERE user_id = %s", (user_id,))
+            res = cur.fetchone()
+            my_count = res[0] if res else 0
+            cur.execute("SELECT COUNT(*) + 1 FROM users WHERE referral_count > %s", (my_count,))
+            my_rank = cur.fetchone()[0]
+            cur.execute("SELECT first_name, referral_count FROM users ORDER BY referral_count DESC LIMIT 3")
+            top_3 = cur.fetchall()
         return (my_count, my_rank, top_3)
     except Exception: return (0, 0, [])
 
 def get_total_users():
     if not DATABASE_URL: return 0
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM users")
-        count = cur.fetchone()[0]
-        cur.close()
-        conn.close()
-        return count
+        with get_cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM users")
+            return cur.fetchone()[0]
     except Exception: return 0
 
-def get_all_users_ids():
-    if not DATABASE_URL: return []
+# --- ALERTAS ---
+def load_alerts():
+    if not DATABASE_URL: return
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE status = 'active'")
-        ids = [row[0] for row in cur.fetchall()]
-        cur.close()
-        conn.close()
-        return ids
-    except Exception: return []
+        with get_cursor() as cur:
+            cur.execute("SELECT id, user_id, target_price, condition FROM alerts")
+            rows = cur.fetchall()
+        ALERT_INDEX.load(rows)
+        logging.info(f"🔔 Alertas en memoria: {len(ALERT_INDEX)}")
+    except Exception as e: logging.error(f"Error load_alerts: {e}")
 
-# --- ALERTAS ---
 def add_alert(user_id, target_price, condition):
     if not DATABASE_URL: return False
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) FROM alerts WHERE user_id = %s", (user_id,))
-        count = cur.fetchone()[0]
-        if count >= 3:
-            cur.close()
-            conn.close()
-            return False
-        cur.execute("INSERT INTO alerts (user_id, target_price, condition) VALUES (%s, %s, %s)", 
-                    (user_id, target_price, condition))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with get_cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM alerts WHERE user_id = %s", (user_id,))
+            count = cur.fetchone()[0]
+            if count >= 3: return False
+            cur.execute("INSERT INTO alerts (user_id, target_price, condition) VALUES (%s, %s, %s) RETURNING id", 
+                        (user_id, target_price, condition))
+            alert_id = cur.fetchone()[0]
+        ALERT_INDEX.add(alert_id, user_id, target_price, condition)
         return True
     except Exception: return False
 
 def get_triggered_alerts(current_price):
     if not DATABASE_URL: return []
-    triggered = []
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT id, user_id, target_price FROM alerts WHERE condition = 'ABOVE' AND %s >= target_price", (current_price,))
-        above = cur.fetchall()
-        cur.execute("SELECT id, user_id, target_price FROM alerts WHERE condition = 'BELOW' AND %s <= target_price", (current_price,))
-        below = cur.fetchall()
-        triggered = above + below
-        if triggered:
-            ids = tuple([t[0] for t in triggered])
-            cur.execute(f"DELETE FROM alerts WHERE id IN {ids}")
-            conn.commit()
-        cur.close()
-        conn.close()
-    except Exception: pass
+    if not ALERT_INDEX.loaded: load_alerts()
+    if not ALERT_INDEX.loaded: return []
+    triggered = ALERT_INDEX.pop_triggered(current_price)
+    if triggered:
+        try:
+            with get_cursor() as cur:
+                cur.execute("DELETE FROM alerts WHERE id = ANY(%s)", ([t[0] for t in triggered],))
+        except Exception as e: logging.error(f"Error borrando alertas: {e}")
     return triggered
 
-def save_mining_data(binance, bcv_val, binance_sell):
+def save_mining_data(binance, bcv_val, binance_sell, banks=None):
     if not DATABASE_URL: return
     try:
         today = datetime.now(TIMEZONE).date()
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
         
-        # Spread
-        spread = 0
+        # Spread (NULL sin las dos puntas: un 0 hundiría los promedios)
+        spread = None
         if binance and binance_sell:
             spread = ((binance - binance_sell) / binance) * 100
         
-        cur.execute("""
-            INSERT INTO daily_stats (date, price_sum, count, bcv_price) 
-            VALUES (%s, %s, 1, %s)
-            ON CONFLICT (date) DO UPDATE SET 
-                price_sum = daily_stats.price_sum + %s,
-                count = daily_stats.count + 1,
-                bcv_price = GREATEST(daily_stats.bcv_price, %s)
-        """, (today, binance, bcv_val, binance, bcv_val))
+        # Foto por banco (NULL si el banco no respondió: AVG y spreads lo ignoran)
+        banks = banks or {}
+        bank_cols = []
+        for bank in ("Banesco", "Mercantil", "Provincial"):
+            quote_bank = banks.get(bank) or {}
+            bank_cols += [quote_bank.get("buy") or None, quote_bank.get("sell") or None]
         
-        cur.execute("""
-            INSERT INTO arbitrage_data (buy_pm, sell_pm, buy_banesco, buy_mercantil, buy_provincial, spread_pct)
-            VALUES (%s, %s, 0, 0, 0, %s)
-        """, (binance, binance_sell, spread))
+        with get_cursor() as cur:
+            cur.execute("""
+                INSERT INTO daily_stats (date, price_sum, count, bcv_price) 
+                VALUES (%s, %s, 1, %s)
+                ON CONFLICT (date) DO UPDATE SET 
+                    price_sum = daily_stats.price_sum + %s,
+                    count = daily_stats.count + 1,
+                    bcv_price = GREATEST(daily_stats.bcv_price, %s)
+            """, (today, binance, bcv_val, binance, bcv_val))
         
-        conn.commit()
-        cur.close()
-        conn.close()
+            cur.execute("""
+                INSERT INTO arbitrage_data (buy_pm, sell_pm, buy_banesco, sell_banesco, buy_mercantil, sell_mercantil,
+                                            buy_provincial, sell_provincial, spread_pct)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (binance, binance_sell or None, *bank_cols, spread))
     except Exception as e: logging.error(f"Error mining: {e}")
 
 # ==============================================================================
 #  BACKEND PRECIOS
 # ==============================================================================
-def fetch_binance_raw(trade_type, bank_filter=None):
-    url = "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search"
-    ua = random.choice(USER_AGENTS)
-    headers = {"Content-Type": "application/json", "User-Agent": ua}
-    last_known = MARKET_DATA["price"] if MARKET_DATA["price"] else 600
-    safe_amount = max(2000, min(int(last_known * FILTER_MIN_USD), 20000))
-    pay_types = [bank_filter] if bank_filter else ["PagoMovil", "Banesco", "Mercantil", "Provincial"]
-    payload = {
-        "page": 1, "rows": 3, 
-        "payTypes": pay_types, 
-        "publisherType": "merchant", 
-        "transAmount": str(safe_amount), 
-        "asset": "USDT", "fiat": "VES", "tradeType": trade_type
+def mark_updated():
+    # Solo con precio Binance nuevo: last_updated es la edad del precio que se muestra
+    MARKET_DATA["last_updated"] = datetime.now(TIMEZONE).strftime("%d/%m/%Y %I:%M:%S %p")
+    MARKET_DATA["price_at"] = datetime.now().timestamp()
+    MARKET_DATA["stale"] = False
+    refresh_render()
+
+def refresh_render():
+    if MARKET_DATA["price"]: MARKET_DATA["render"] = build_price_render()
+
+def price_age():
+    at = MARKET_DATA["price_at"]
+    return datetime.now().timestamp() - at if at else None
+
+def stale_detail():
+    if MARKET_DATA["stale"]: return "actualizando..."
+    age = price_age()
+    if age and age > PRICE_STALE_AFTER: return f"hace {int(age // 60)} min"
+    return ""
+
+# --- ARRANQUE EN CALIENTE ---
+def market_state():
+    return {
+        "price": MARKET_DATA["price"], "bcv": MARKET_DATA["bcv"], "last_updated": MARKET_DATA["last_updated"],
+        "price_at": MARKET_DATA["price_at"], "history": MARKET_DATA["history"].items(),
+        # Solo el gráfico público: el de /stats se vuelve a dibujar al pedirlo
+        "charts": {name: entry for name, entry in GRAPH_CACHE.export().items() if name == "price"}
     }
-    try:
-        response = requests.post(url, json=payload, headers=headers, timeout=10)
-        data = response.json()
-        if not data.get("data"):
-            del payload["publisherType"]
-            response = requests.post(url, json=payload, headers=headers, timeout=10)
-            data = response.json()
-        prices = [float(item["adv"]["price"]) for item in data.get("data", [])]
-        return sum(prices) / len(prices) if prices else None
-    except Exception: return None
 
-def fetch_bcv_price():
-    url = "http://www.bcv.org.ve/"
-    headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"}
-    rates = {'usd': None, 'eur': None}
-    try:
-        response = requests.get(url, headers=headers, timeout=30, verify=False)
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.content, 'html.parser')
-            dolar = soup.find('div', id='dolar')
-            if dolar: rates['usd'] = float(dolar.find('strong').text.strip().replace(',', '.'))
-            euro = soup.find('div', id='euro')
-            if euro: rates['eur'] = float(euro.find('strong').text.strip().replace(',', '.'))
-            if rates['usd']: logging.info(f"✅ BCV: {rates['usd']}")
-            return rates if rates['usd'] else None
-    except Exception as e: logging.error(f"❌ BCV Error: {e}")
-    return None
+def load_market_from_db():
+    # Sin snapshot (primer despliegue, disco efímero): últimas 24h de arbitrage_data y el BCV de daily_stats
+    with get_cursor() as cur:
+        cur.execute("""
+            SELECT EXTRACT(EPOCH FROM recorded_at::timestamptz)::float, buy_pm, sell_pm FROM arbitrage_data
+            WHERE recorded_at >= NOW() - INTERVAL '24 hours' AND buy_pm IS NOT NULL
+            ORDER BY recorded_at
+        """)
+        rows = cur.fetchall()
+        cur.execute("SELECT bcv_price FROM daily_stats WHERE bcv_price > 0 ORDER BY date DESC LIMIT 1")
+        bcv = cur.fetchone()
+    if not rows: return None
+    bcv_usd = bcv[0] if bcv else None
+    last_ts = datetime.fromtimestamp(rows[-1][0], TIMEZONE).strftime("%d/%m/%Y %I:%M:%S %p")
+    return {
+        "price": rows[-1][1], "bcv": {'usd': bcv_usd, 'eur': None}, "last_updated": last_ts, "price_at": rows[-1][0],
+        "history": [(ts, buy, sell, bcv_usd) for ts, buy, sell in rows], "charts": {}
+    }
+
+def restore_market_state():
+    # Antes de abrir el webhook: lo último conocido se sirve (marcado) hasta que llegue el primer tick
+    state, source = load_snapshot(), "snapshot"
+    if not state and DATABASE_URL:
+        source = "BD"
+        try: state = load_market_from_db()
+        except Exception as e: logging.error(f"Error restaurando mercado: {e}")
+    if not state or not state.get("price"): return None
+    MARKET_DATA["price"] = state["price"]
+    MARKET_DATA["bcv"] = state.get("bcv") or {'usd': None, 'eur': None}
+    MARKET_DATA["last_updated"] = state.get("last_updated") or MARKET_DATA["last_updated"]
+    MARKET_DATA["price_at"] = state.get("price_at")
+    for row in state.get("history", []): MARKET_DATA["history"].append(*row)
+    GRAPH_CACHE.restore(state.get("charts", {}))
+    MARKET_DATA["stale"] = True
+    MARKET_DATA["render"] = build_price_render()
+    logging.info(f"♻️ Mercado restaurado desde {source}: {MARKET_DATA['price']:,.2f} Bs ({MARKET_DATA['last_updated']}, {len(MARKET_DATA['history'])} puntos)")
+    return source
+
+def stale_note():
+    detail = stale_detail()
+    return f"\n⏳ <i>Tasa del {MARKET_DATA['last_updated']}, {detail}</i>" if detail else ""
 
 async def update_price_task(context: ContextTypes.DEFAULT_TYPE):
-    buy_pm = await asyncio.to_thread(fetch_binance_raw, "BUY", "PagoMovil")
-    await asyncio.sleep(random.uniform(0.5, 1.5))
-    sell_pm = await asyncio.to_thread(fetch_binance_raw, "SELL", "PagoMovil")
-    
-    new_bcv = await asyncio.to_thread(fetch_bcv_price)
+    # Todas las fuentes en paralelo; el BCV (lento) no retiene el precio Binance
+    deadline = tick_deadline()
+    bcv_task = start_bcv_fetch()
+    # El precio principal se publica en cuanto llega; los demás bancos (solo spreads) siguen en paralelo
+    main_task, rest_task = start_binance_collect(MARKET_DATA["price"])
+    # Todo bajo el mismo plazo del tick: si se agota, se sigue sirviendo el último precio bueno
+    main = await until_deadline(main_task, deadline)
+    if main is None:
+        logging.warning("⏱ Binance sin respuesta dentro del plazo del tick")
+        main = {}
+    quote = main.get(MAIN_PAY_TYPE) or {}
+    buy_pm, sell_pm = quote.get("buy"), quote.get("sell")
     
     if buy_pm:
         MARKET_DATA["price"] = buy_pm
-        MARKET_DATA["history"].append(buy_pm)
-        if len(MARKET_DATA["history"]) > MAX_HISTORY_POINTS: MARKET_DATA["history"].pop(0)
+        MARKET_DATA["history"].append(datetime.now().timestamp(), buy_pm, sell_pm, MARKET_DATA["bcv"].get('usd'))
+        mark_updated()
         
         alerts = await asyncio.to_thread(get_triggered_alerts, buy_pm)
         if alerts:
@@ -707,25 +667,30 @@ async def update_price_task(context: ContextTypes.DEFAULT_TYPE):
                 try:
                     await context.bot.send_message(chat_id=alert[1], text=f"{EMOJI_ALERTA} <b>¡ALERTA!</b>\nDólar en meta: <b>{alert[2]:,.2f} Bs</b>\nActual: {buy_pm:,.2f} Bs", parse_mode=ParseMode.HTML)
                 except Exception: pass
-        
+    
+    new_bcv = await until_deadline(bcv_task, deadline)
+    banks = {**main, **(await until_deadline(rest_task, deadline) or {})}
+    
+    if buy_pm:
         bcv_val = new_bcv['usd'] if (new_bcv and new_bcv.get('usd')) else 0
-        await asyncio.to_thread(save_mining_data, buy_pm, bcv_val, sell_pm)
+        await asyncio.to_thread(save_mining_data, buy_pm, bcv_val, sell_pm, banks)
+        context.application.create_task(prerender_public_chart(context.bot))
 
     if new_bcv: MARKET_DATA["bcv"] = new_bcv
+    # BCV nuevo, o la edad del precio si Binance no respondió (se sigue sirviendo el último bueno)
+    refresh_render()
     if buy_pm or new_bcv:
-        now = datetime.now(TIMEZONE)
-        MARKET_DATA["last_updated"] = now.strftime("%d/%m/%Y %I:%M:%S %p")
-        logging.info(f"🔄 Actualizado - PM: {buy_pm} | Sell: {sell_pm}")
+        bank_log = " | ".join(f"{bank}: {q['buy']}/{q['sell']}" for bank, q in banks.items() if bank != MAIN_PAY_TYPE)
+        logging.info(f"🔄 Actualizado - PM: {buy_pm} | Sell: {sell_pm} | {bank_log}")
+        if MARKET_DATA["price"]: await asyncio.to_thread(save_snapshot, market_state())
 
 # --- NEW: COMANDO DEBUG ---
 async def debug_mining(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM arbitrage_data ORDER BY id DESC LIMIT 1")
-        row = cur.fetchone()
-        cur.close(); conn.close()
+        with get_cursor() as cur:
+            cur.execute("SELECT * FROM arbitrage_data ORDER BY recorded_at DESC LIMIT 1")
+            row = cur.fetchone()
         
         if row:
             msg = (
@@ -734,7 +699,8 @@ async def debug_mining(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"🟢 Buy PM: {row[2]}\n"
                 f"🔴 Sell PM: {row[3]}\n"
                 f"📉 Spread: {row[7]:.2f}%\n"
-                f"🏦 Ban: {row[4]} | Mer: {row[5]} | Pro: {row[6]}"
+                f"🏦 Ban: {row[4]} | Mer: {row[5]} | Pro: {row[6]}\n"
+                f"🏦 Venta Ban: {row[8]} | Mer: {row[9]} | Pro: {row[10]}"
             )
             await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
         else:
@@ -745,19 +711,27 @@ async def debug_mining(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ... (El resto de comandos precio, start, etc. se mantienen igual a la V49) ...
 # (Para no hacer el mensaje muy largo, asegúrate de mantener las funciones build_price_message, etc.)
 
-def get_sentiment_keyboard(user_id):
-    if has_user_voted(user_id):
-        up, down = get_vote_results()
-        share_text = quote(f"🔥 Dólar en {MARKET_DATA['price']:.2f} Bs. Revisa la tasa real aquí:")
-        share_url = f"https://t.me/share/url?url=https://t.me/tasabinance_bot&text={share_text}"
-        return [[InlineKeyboardButton("🔄 Actualizar Precio", callback_data='refresh_price')], [InlineKeyboardButton("📤 Compartir con Amigos", url=share_url)]]
-    else:
-        return [[InlineKeyboardButton("🚀 Subirá", callback_data='vote_up'), InlineKeyboardButton("📉 Bajará", callback_data='vote_down')], [InlineKeyboardButton("🔄 Actualizar Precio", callback_data='refresh_price')]]
+def voted_keyboard(binance):
+    share_text = quote(f"🔥 Dólar en {binance:.2f} Bs. Revisa la tasa real aquí:")
+    share_url = f"https://t.me/share/url?url=https://t.me/tasabinance_bot&text={share_text}"
+    return [[InlineKeyboardButton("🔄 Actualizar Precio", callback_data='refresh_price')], [InlineKeyboardButton("📤 Compartir con Amigos", url=share_url)]]
+
+NOT_VOTED_KEYBOARD = [[InlineKeyboardButton("🚀 Subirá", callback_data='vote_up'), InlineKeyboardButton("📉 Bajará", callback_data='vote_down')], [InlineKeyboardButton("🔄 Actualizar Precio", callback_data='refresh_price')]]
+PRICE_FOOTER = "📢 <b>Síguenos:</b> @tasabinance_bot"
+
+def trend_block(history):
+    # Solo ventanas con datos suficientes; las estadísticas ya vienen calculadas del tick
+    day = history.window(86400)
+    parts = [f"<b>{label}:</b> {s['change']:+.2f}%" for label, s in (("1h", history.window(3600)), ("24h", day)) if s and s["full"]]
+    if not parts: return ""
+    text = f"{EMOJI_STATS} " + " | ".join(parts) + "\n"
+    if day and day["full"]: text += f"↕️ <b>Rango 24h:</b> {day['min']:,.2f} - {day['max']:,.2f} Bs\n"
+    return text
 
-def build_price_message(binance, bcv_data, time_str, user_id=None, requests_count=0):
+def build_price_body(binance, bcv_data, time_str, requests_count=0, trend=""):
     paypal = binance * 0.90
     amazon = binance * 0.75
-    text = f"{EMOJI_STATS} <b>MONITOR DE TASAS</b>\n\n{EMOJI_BINANCE} <b>Tasa Binance:</b> {binance:,.2f} Bs\n\n"
+    text = f"{EMOJI_STATS} <b>MONITOR DE TASAS</b>\n\n{EMOJI_BINANCE} <b>Tasa Binance:</b> {binance:,.2f} Bs\n{trend}\n"
     if bcv_data:
         if bcv_data.get('usd'):
             text += f"🏛️ <b>BCV (Dólar):</b> {bcv_data['usd']:,.2f} Bs\n"
@@ -770,28 +744,67 @@ def build_price_message(binance, bcv_data, time_str, user_id=None, requests_coun
     text += f"{EMOJI_PAYPAL} <b>Tasa PayPal:</b> {paypal:,.2f} Bs\n{EMOJI_AMAZON} <b>Giftcard Amazon:</b> {amazon:,.2f} Bs\n\n{EMOJI_STORE} <i>Actualizado: {time_str}</i>\n"
     if requests_count > 100: text += f"👁 <b>{requests_count:,}</b> consultas hoy\n\n"
     else: text += "\n"
-    if user_id and has_user_voted(user_id):
-        up, down = get_vote_results()
-        total = up + down
-        if total > 0:
-            up_pct = int((up / total) * 100)
-            down_pct = int((down / total) * 100)
-            text += f"🗣️ <b>¿Qué dice la comunidad?</b>\n🚀 {up_pct}% <b>Alcista</b> | 📉 {down_pct}% <b>Bajista</b>\n\n"
-    elif user_id: text += "🗣️ <b>¿Qué dice la comunidad?</b> 👇\n\n"
-    text += "📢 <b>Síguenos:</b> @tasabinance_bot"
     return text
 
+def sentiment_block(up, down):
+    total = up + down
+    if total <= 0: return ""
+    up_pct = int((up / total) * 100)
+    down_pct = int((down / total) * 100)
+    return f"🗣️ <b>¿Qué dice la comunidad?</b>\n🚀 {up_pct}% <b>Alcista</b> | 📉 {down_pct}% <b>Bajista</b>\n\n"
+
+def build_price_message(binance, bcv_data, time_str, user_id=None, requests_count=0, trend=""):
+    text = build_price_body(binance, bcv_data, time_str, requests_count, trend)
+    if user_id and has_user_voted(user_id): text += sentiment_block(*get_vote_results())
+    elif user_id: text += "🗣️ <b>¿Qué dice la comunidad?</b> 👇\n\n"
+    return text + PRICE_FOOTER
+
+# --- RENDER POR TICK ---
+# Se arma una vez por tick (el contador de consultas queda fijo hasta el siguiente);
+# los handlers solo eligen variante y comparan el hash para no editar si nada cambió
+PriceRender = namedtuple("PriceRender", "base not_voted voted_markup not_voted_markup hash")
+
+def build_price_render():
+    binance = MARKET_DATA["price"]
+    detail = stale_detail()
+    time_str = MARKET_DATA["last_updated"] + (f" ⏳ {detail}" if detail else "")
+    base = build_price_body(binance, MARKET_DATA["bcv"], time_str, get_daily_requests_count(), trend_block(MARKET_DATA["history"]))
+    voted = voted_keyboard(binance)
+    digest = hashlib.sha1((base + repr(voted)).encode()).hexdigest()[:16]
+    return PriceRender(
+        base=base,
+        not_voted=base + "🗣️ <b>¿Qué dice la comunidad?</b> 👇\n\n" + PRICE_FOOTER,
+        voted_markup=InlineKeyboardMarkup(voted),
+        not_voted_markup=InlineKeyboardMarkup(NOT_VOTED_KEYBOARD),
+        hash=digest
+    )
+
+@lru_cache(maxsize=32)
+def _voted_text(base, up, down):
+    return base + sentiment_block(up, down) + PRICE_FOOTER
+
+def pick_price_render(user_id):
+    # -> (texto, teclado, hash del contenido)
+    render = MARKET_DATA.get("render")
+    if render is None:
+        render = build_price_render()
+        MARKET_DATA["render"] = render
+    if has_user_voted(user_id):
+        up, down = get_vote_results()
+        return _voted_text(render.base, up, down), render.voted_markup, f"{render.hash}:v{up}:{down}"
+    return render.not_voted, render.not_voted_markup, f"{render.hash}:n"
+
 async def send_daily_report(context: ContextTypes.DEFAULT_TYPE):
     binance = MARKET_DATA["price"]
     bcv = MARKET_DATA["bcv"]
-    if not binance: binance = await asyncio.to_thread(fetch_binance_price)
-    if not bcv: bcv = await asyncio.to_thread(fetch_bcv_price)
+    if not binance: binance = (await collect_binance(pay_types=[MAIN_PAY_TYPE]))[MAIN_PAY_TYPE]["buy"]
+    if not bcv: bcv = await start_bcv_fetch()
     if not binance: return
 
     time_str = datetime.now(TIMEZONE).strftime("%d/%m/%Y %I:%M:%S %p")
     hour = datetime.now(TIMEZONE).hour
     header = "☀️ <b>¡Buenos días! Así abre el mercado:</b>" if hour < 12 else "🌤 <b>Reporte de la Tarde:</b>"
-    body = build_price_message(binance, bcv, time_str)
+    body = build_price_message(binance, bcv, time_str, trend=trend_block(MARKET_DATA["history"]))
     body = body.replace(f"{EMOJI_STATS} <b>MONITOR DE TASAS</b>\n\n", "")
     text = f"{header}\n\n{body}"
     
@@ -800,10 +813,10 @@ async def send_daily_report(context: ContextTypes.DEFAULT_TYPE):
 def queue_broadcast(message):
     if not DATABASE_URL: return
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("INSERT INTO broadcast_queue (message, status) VALUES (%s, 'pending')", (message,))
-        conn.commit(); cur.close(); conn.close()
+        with get_cursor() as cur:
+            cur.execute("INSERT INTO broadcast_queue (message, status) VALUES (%s, 'pending') RETURNING id", (message,))
+            # El NOTIFY se entrega al hacer commit: el worker arranca sin esperar al sondeo
+            cur.execute("SELECT pg_notify(%s, %s)", (BROADCAST_CHANNEL, str(cur.fetchone()[0])))
     except Exception: pass
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -812,7 +825,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try: referrer_id = int(context.args[0])
         except ValueError: referrer_id = None
     await asyncio.to_thread(track_user, update.effective_user, referrer_id)
-    await asyncio.to_thread(log_activity, update.effective_user.id, "/start")
+    log_activity(update.effective_user.id, "/start")
     mensaje = (
         f"👋 <b>¡Bienvenido al Monitor P2P Inteligente!</b>\n\n"
         f"Soy tu asistente financiero conectado a {EMOJI_BINANCE} <b>Binance P2P</b> y al <b>BCV</b>.\n\n"
@@ -836,28 +849,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def grafico(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     await asyncio.to_thread(track_user, update.effective_user)
-    await asyncio.to_thread(log_activity, user_id, "/grafico")
-    global GRAPH_CACHE
-    today_str = datetime.now(TIMEZONE).date().isoformat()
-    if GRAPH_CACHE["date"] == today_str and GRAPH_CACHE["photo_id"]:
+    log_activity(user_id, "/grafico")
+    entry = GRAPH_CACHE.get("price")
+    # Sin file_id o sin confirmar hace rato (p. ej. restaurado del snapshot): revalidar contra la BD
+    if not entry or not entry["file_id"] or datetime.now().timestamp() - entry["rendered_at"] >= CHART_REFRESH_INTERVAL:
+        await update.message.reply_chat_action("upload_photo")
+        entry = await get_public_chart(max_age=CHART_REFRESH_INTERVAL)
+    if not entry:
+        await update.message.reply_text("📉 Recopilando datos históricos. Vuelve pronto.")
+        return
+    if entry["file_id"]:
         try:
-            await update.message.reply_photo(photo=GRAPH_CACHE["photo_id"], caption="📉 <b>Promedio Diario (Semanal)</b>\n\n📲 <i>¡Compártelo en tus estados!</i>\n\n@tasabinance_bot", parse_mode=ParseMode.HTML)
+            await update.message.reply_photo(photo=entry["file_id"], caption="📉 <b>Promedio Diario (Semanal)</b>\n\n📲 <i>¡Compártelo en tus estados!</i>\n\n@tasabinance_bot", parse_mode=ParseMode.HTML)
             return
-        except Exception: GRAPH_CACHE["photo_id"] = None
-    await update.message.reply_chat_action("upload_photo")
-    img_buf = await asyncio.to_thread(generate_public_price_chart)
-    if img_buf:
-        msg = await update.message.reply_photo(photo=img_buf, caption="📉 <b>Promedio Diario (Semanal)</b>\n\n<i>Precio promedio ponderado del día.</i>", parse_mode=ParseMode.HTML)
-        if msg.photo:
-            GRAPH_CACHE["date"] = today_str
-            GRAPH_CACHE["photo_id"] = msg.photo[-1].file_id
-    else:
-        await update.message.reply_text("📉 Recopilando datos históricos. Vuelve pronto.")
+        except Exception: GRAPH_CACHE.set_file_id("price", entry["fingerprint"], None)
+    msg = await update.message.reply_photo(photo=entry["png"], caption="📉 <b>Promedio Diario (Semanal)</b>\n\n<i>Precio promedio ponderado del día.</i>", parse_mode=ParseMode.HTML)
+    if msg.photo: GRAPH_CACHE.set_file_id("price", entry["fingerprint"], msg.photo[-1].file_id)
 
 async def referidos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     await asyncio.to_thread(track_user, update.effective_user)
-    await asyncio.to_thread(log_activity, user_id, "/referidos")
+    log_activity(user_id, "/referidos")
     count, rank, top_3 = await asyncio.to_thread(get_referral_stats, user_id)
     ranking_text = ""
     medals = ["🥇", "🥈", "🥉"]
@@ -875,18 +887,16 @@ async def referidos(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def precio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     await asyncio.to_thread(track_user, update.effective_user)
-    await asyncio.to_thread(log_activity, user_id, "/precio")
-    binance = MARKET_DATA["price"]
-    bcv = MARKET_DATA["bcv"]
-    time_str = MARKET_DATA["last_updated"]
-    if binance:
-        req_count = await asyncio.to_thread(get_daily_requests_count)
-        text = build_price_message(binance, bcv, time_str, user_id, req_count)
-        keyboard = get_sentiment_keyboard(user_id)
+    log_activity(user_id, "/precio")
+    if MARKET_DATA["price"]:
+        text, markup, digest = pick_price_render(user_id)
         if random.random() < 0.2:
             days, refs = await asyncio.to_thread(get_user_loyalty, user_id)
-            if days > 3 and refs == 0: text += "\n\n🎁 <i>¡Gana $10 USDT invitando amigos! Toca /referidos</i>"
-        await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
+            if days > 3 and refs == 0:
+                text += "\n\n🎁 <i>¡Gana $10 USDT invitando amigos! Toca /referidos</i>"
+                digest = None
+        sent = await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+        context.chat_data["price_render"] = (sent.message_id, digest)
     else: await update.message.reply_text("🔄 Iniciando sistema... intenta en unos segundos.")
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -897,49 +907,66 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data in ['vote_up', 'vote_down']:
         vote_type = 'UP' if data == 'vote_up' else 'DOWN'
         if await asyncio.to_thread(cast_vote, user_id, vote_type):
-            await asyncio.to_thread(log_activity, user_id, f"vote_{vote_type.lower()}")
+            log_activity(user_id, f"vote_{vote_type.lower()}")
             await query.answer("✅ ¡Voto registrado!")
         else: await query.answer("⚠️ Ya votaste hoy.")
         data = 'refresh_price'
     if data == 'refresh_price':
-        await asyncio.to_thread(log_activity, user_id, "btn_refresh")
-        binance = MARKET_DATA["price"]
-        bcv = MARKET_DATA["bcv"]
-        time_str = MARKET_DATA["last_updated"]
-        if binance:
-            req_count = await asyncio.to_thread(get_daily_requests_count)
-            text = build_price_message(binance, bcv, time_str, user_id, req_count)
-            keyboard = get_sentiment_keyboard(user_id)
-            try: await query.edit_message_text(text=text, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
-            except BadRequest: pass
-            except Exception as e: logging.error(f"Error edit: {e}")
+        log_activity(user_id, "btn_refresh")
+        if MARKET_DATA["price"]:
+            text, markup, digest = pick_price_render(user_id)
+            # Mismo contenido que ya muestra el mensaje: Telegram respondería "message is not modified"
+            message_id = query.message.message_id if query.message else None
+            chat_data = context.chat_data if context.chat_data is not None else {}
+            if chat_data.get("price_render") != (message_id, digest):
+                try:
+                    await query.edit_message_text(text=text, parse_mode=ParseMode.HTML, reply_markup=markup)
+                    chat_data["price_render"] = (message_id, digest)
+                except BadRequest: pass
+                except Exception as e: logging.error(f"Error edit: {e}")
     try: await query.answer()
     except: pass
 
+def ia_windows_block(history):
+    text = ""
+    for window, label in ((21600, "6h"), (86400, "24h")):
+        s = history.window(window)
+        if s and s["full"]:
+            text += f"• <b>{label}:</b> {s['change']:+.2f}% | Media {s['mean']:,.2f} | {s['min']:,.2f} - {s['max']:,.2f} Bs\n"
+    return text
+
 async def prediccion(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await asyncio.to_thread(track_user, update.effective_user)
-    await asyncio.to_thread(log_activity, update.effective_user.id, "/ia")
+    log_activity(update.effective_user.id, "/ia")
     history = MARKET_DATA["history"]
-    if len(history) < 5:
+    hour = history.window(3600)
+    if len(history) < 5 or not hour:
         await update.message.reply_text("🧠 <b>Calibrando IA...</b>\nRecopilando datos.", parse_mode=ParseMode.HTML)
         return
-    start_p, end_p = history[0], history[-1]
-    percent = ((end_p - start_p) / start_p) * 100
+    percent = hour["change"]
+    # Si aún no hay una hora completa, la etiqueta dice el tramo real
+    span = "1h" if hour["full"] else f"{max(1, round(hour['span'] / 60))} min"
     if percent > 0.5: emoji, status, msg = EMOJI_SUBIDA, "ALCISTA FUERTE", "Subida rápida."
     elif percent > 0: emoji, status, msg = EMOJI_SUBIDA, "LIGERAMENTE ALCISTA", "Recuperación."
     elif percent < -0.5: emoji, status, msg = EMOJI_BAJADA, "BAJISTA FUERTE", "Caída rápida."
     elif percent < 0: emoji, status, msg = EMOJI_BAJADA, "LIGERAMENTE BAJISTA", "Corrección."
     else: emoji, status, msg = "⚖️", "LATERAL / ESTABLE", "Sin cambios."
     text = (f"🧠 <b>ANÁLISIS DE MERCADO (IA)</b>\n<i>Tendencia basada en historial reciente.</i>\n\n"
-            f"{emoji} <b>Estado:</b> {status}\n{EMOJI_STATS} <b>Variación (1h):</b> {percent:.2f}%\n\n"
+            f"{emoji} <b>Estado:</b> {status}\n{EMOJI_STATS} <b>Variación ({span}):</b> {percent:.2f}%\n"
+            f"{ia_windows_block(history)}\n"
             f"💡 <b>Conclusión:</b>\n<i>{msg}</i>\n\n⚠️ <i>No es consejo financiero.</i>")
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    chart = await asyncio.to_thread(generate_stats_chart)
-    report = await asyncio.to_thread(get_detailed_report_text)
-    if chart: await context.bot.send_photo(chat_id=ADMIN_ID, photo=chart, caption=report, parse_mode=ParseMode.HTML)
+    snapshot = await asyncio.to_thread(get_stats_snapshot)
+    if not snapshot:
+        await update.message.reply_text("❌ Error generando gráfico.")
+        return
+    chart_data = (snapshot["growth"], tuple(snapshot["top_commands"][:5]))
+    chart = await GRAPH_CACHE.render("stats", chart_data, render_stats_chart, *chart_data)
+    report = get_detailed_report_text(snapshot)
+    if chart: await context.bot.send_photo(chat_id=ADMIN_ID, photo=chart["png"], caption=report, parse_mode=ParseMode.HTML)
     else: await update.message.reply_text("❌ Error generando gráfico.")
 
 async def global_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -956,7 +983,7 @@ async def global_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def start_alert(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await asyncio.to_thread(track_user, update.effective_user)
-    await asyncio.to_thread(log_activity, update.effective_user.id, "/alerta")
+    log_activity(update.effective_user.id, "/alerta")
     if context.args:
         try:
             target = float(context.args[0].replace(',', '.'))
@@ -1004,27 +1031,27 @@ async def calculate_conversion(update: Update, text_amount, currency_type):
     try:
         clean_text = ''.join(c for c in text_amount if c.isdigit() or c in '.,')
         amount = float(clean_text.replace(',', '.'))
-        await asyncio.to_thread(log_calc, update.effective_user.id, amount, currency_type, 0)
+        log_calc(update.effective_user.id, amount, currency_type, 0)
         if currency_type == "USDT":
             total = amount * rate
-            await update.message.reply_text(f"🇺🇸 {amount:,.2f} USDT son:\n🇻🇪 <b>{total:,.2f} Bolívares</b>\n<i>(Tasa: {rate:,.2f})</i>", parse_mode=ParseMode.HTML)
+            await update.message.reply_text(f"🇺🇸 {amount:,.2f} USDT son:\n🇻🇪 <b>{total:,.2f} Bolívares</b>\n<i>(Tasa: {rate:,.2f})</i>{stale_note()}", parse_mode=ParseMode.HTML)
         else: 
             total = amount / rate
-            await update.message.reply_text(f"🇻🇪 {amount:,.2f} Bs son:\n🇺🇸 <b>{total:,.2f} USDT</b>\n<i>(Tasa: {rate:,.2f})</i>", parse_mode=ParseMode.HTML)
+            await update.message.reply_text(f"🇻🇪 {amount:,.2f} Bs son:\n🇺🇸 <b>{total:,.2f} USDT</b>\n<i>(Tasa: {rate:,.2f})</i>{stale_note()}", parse_mode=ParseMode.HTML)
     except ValueError:
         await update.message.reply_text("🔢 Número inválido.")
     return ConversationHandler.END
 
 async def start_usdt_calc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await asyncio.to_thread(track_user, update.effective_user)
-    await asyncio.to_thread(log_activity, update.effective_user.id, "/calc")
+    log_activity(update.effective_user.id, "/calc")
     if context.args: return await calculate_conversion(update, context.args[0], "USDT")
     await update.message.reply_text("🇺🇸 <b>Calculadora USDT:</b>\n\n¿Cuántos Dólares?\n<i>Escribe el número:</i>", parse_mode=ParseMode.HTML)
     return ESPERANDO_INPUT_USDT
 
 async def start_bs_calc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await asyncio.to_thread(track_user, update.effective_user)
-    await asyncio.to_thread(log_activity, update.effective_user.id, "/calc")
+    log_activity(update.effective_user.id, "/calc")
     if context.args: return await calculate_conversion(update, context.args[0], "BS")
     await update.message.reply_text("🇻🇪 <b>Calculadora Bolívares:</b>\n\n¿Cuántos Bs?\n<i>Escribe el número:</i>", parse_mode=ParseMode.HTML)
     return ESPERANDO_INPUT_BS
@@ -1044,28 +1071,79 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def debug_mining(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM arbitrage_data ORDER BY id DESC LIMIT 1")
-        row = cur.fetchone()
-        cur.close(); conn.close()
+        with get_cursor() as cur:
+            cur.execute("SELECT * FROM arbitrage_data ORDER BY recorded_at DESC LIMIT 1")
+            row = cur.fetchone()
         if row:
-            msg = (f"🕵️‍♂️ <b>DATA MINING DEBUG</b>\n\n🕒 Time: {row[1]}\n🟢 Buy PM: {row[2]}\n🔴 Sell PM: {row[3]}\n📉 Spread: {row[7]:.2f}%\n🏦 Ban: {row[4]} | Mer: {row[5]} | Pro: {row[6]}")
+            msg = (f"🕵️‍♂️ <b>DATA MINING DEBUG</b>\n\n🕒 Time: {row[1]}\n🟢 Buy PM: {row[2]}\n🔴 Sell PM: {row[3]}\n📉 Spread: {row[7]:.2f}%\n🏦 Ban: {row[4]} | Mer: {row[5]} | Pro: {row[6]}\n🏦 Venta Ban: {row[8]} | Mer: {row[9]} | Pro: {row[10]}")
             await update.message.reply_text(msg, parse_mode=ParseMode.HTML)
         else: await update.message.reply_text("❌ No hay data.")
     except Exception as e: await update.message.reply_text(f"❌ Error: {e}")
 
+async def fuentes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Salud de las fuentes de precio (circuito, fallos, edad del último dato bueno)
+    if update.effective_user.id != ADMIN_ID: return
+    icons = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}
+    lines = ["🩺 <b>FUENTES DE PRECIO</b>\n"]
+    for name, h in source_health().items():
+        age = f"{h['last_success_age']}s" if h['last_success_age'] is not None else "nunca"
+        line = f"{icons[h['state']]} <b>{name.upper()}</b>: {h['state']} | fallos {h['failures']} | último OK hace {age}"
+        if h['retry_in']: line += f" | reintento en {h['retry_in']}s"
+        if h['last_error'] and h['state'] != "closed": line += f"\n   <code>{html_escape(h['last_error'])}</code>"
+        lines.append(line)
+    age = price_age()
+    lines.append(f"\n💵 Precio servido: {MARKET_DATA['price'] or '-'} ({f'hace {int(age)}s' if age else 'sin datos'})")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.error(msg="Exception while handling an update:", exc_info=context.error)
 
+# --- ARRANQUE ---
+STARTUP_TIMINGS = {}
+STARTUP_PHASE = {"t": STARTUP_T0, "warm_up": None}
+
+def mark_phase(name, started):
+    STARTUP_TIMINGS[name] = perf_counter() - started
+    return perf_counter()
+
+async def warm_up():
+    # Cachés desde la BD después de abrir el webhook: los handlers ya funcionan sin ellas
+    started = perf_counter()
+    for name, loader in (("alertas", load_alerts), ("ranking", load_leaderboard), ("votos", load_votes), ("contador", seed_request_count)):
+        t = perf_counter()
+        await asyncio.to_thread(loader)
+        logging.info(f"⏱ Precarga {name}: {(perf_counter() - t) * 1000:.0f} ms")
+    logging.info(f"⏱ Precarga completa en {perf_counter() - started:.2f}s")
+
+async def on_startup(application):
+    mark_phase("post_init", STARTUP_PHASE["t"])
+    phases = " | ".join(f"{name} {secs * 1000:.0f} ms" for name, secs in STARTUP_TIMINGS.items())
+    logging.info(f"⏱ Arranque en {perf_counter() - STARTUP_T0:.2f}s ({phases})")
+    STARTUP_PHASE["warm_up"] = asyncio.get_running_loop().create_task(warm_up())
+
+async def on_shutdown(application):
+    if MARKET_DATA["price"]: save_snapshot(market_state())
+    await close_sessions()
+    shutdown_renderer()
+    ACTIVITY_SINK.stop()
+    CALC_SINK.stop()
+    persist_request_count()
+    close_pool()
+
 if __name__ == "__main__":
+    t = mark_phase("imports", STARTUP_T0)
     init_db()
+    t = mark_phase("esquema", t)
+    restore_market_state()
+    t = mark_phase("snapshot", t)
     if not TOKEN: exit(1)
+    ACTIVITY_SINK.start()
+    CALC_SINK.start()
     
     WEBHOOK_URL = os.getenv("WEBHOOK_URL")
     PORT = int(os.environ.get("PORT", "8080"))
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    app = ApplicationBuilder().token(TOKEN).post_init(on_startup).post_shutdown(on_shutdown).build()
     app.add_error_handler(error_handler)
     
     conv_usdt = ConversationHandler(
@@ -1095,13 +1173,19 @@ if __name__ == "__main__":
     app.add_handler(CommandHandler("referidos", referidos)) 
     app.add_handler(CommandHandler("grafico", grafico)) 
     app.add_handler(CommandHandler("debug", debug_mining))
+    app.add_handler(CommandHandler("fuentes", fuentes))
     app.add_handler(CallbackQueryHandler(button_handler))
     
     if app.job_queue:
         app.job_queue.run_repeating(update_price_task, interval=UPDATE_INTERVAL, first=1)
         app.job_queue.run_daily(send_daily_report, time=time(hour=9, minute=0, tzinfo=TIMEZONE), days=(0, 1, 2, 3, 4, 5, 6))
         app.job_queue.run_daily(send_daily_report, time=time(hour=13, minute=0, tzinfo=TIMEZONE), days=(0, 1, 2, 3, 4, 5, 6))
+        app.job_queue.run_daily(rollover_task, time=time(hour=0, minute=0, second=1, tzinfo=TIMEZONE))
+        app.job_queue.run_repeating(persist_counters_task, interval=COUNTER_PERSIST_INTERVAL, first=COUNTER_PERSIST_INTERVAL)
+        app.job_queue.run_daily(compact_storage_task, time=time(hour=3, minute=30, tzinfo=TIMEZONE))
     
+    # El webhook se abre tras post_init; el primer tick y la precarga corren ya sirviendo
+    STARTUP_PHASE["t"] = mark_phase("app", t)
     if WEBHOOK_URL:
         print(f"🚀 Iniciando modo WEBHOOK en puerto {PORT}")
         app.run_webhook(listen="0.0.0.0", port=PORT, url_path=TOKEN, webhook_url=f"{WEBHOOK_URL}/{TOKEN}")
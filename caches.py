@@ -0,0 +1,292 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from math import isnan
+
+INF = float('inf')
+NAN = float('nan')
+
+# ==============================================================================
+#  USUARIOS CONOCIDOS
+# ==============================================================================
+class UserCache:
+    # LRU de usuarios vistos: user_id -> (first_name, instante de la última escritura)
+    def __init__(self, ttl=300, max_size=50000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_fresh(self, user_id, first_name):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if not entry: return False
+            name, written = entry
+            if name != first_name or time.monotonic() - written >= self.ttl: return False
+            self._users.move_to_end(user_id)
+            return True
+
+    def mark(self, user_id, first_name):
+        with self._lock:
+            self._users[user_id] = (first_name, time.monotonic())
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_size: self._users.popitem(last=False)
+
+    def forget(self, user_id):
+        with self._lock: self._users.pop(user_id, None)
+
+# ==============================================================================
+#  ÍNDICE DE ALERTAS
+# ==============================================================================
+class AlertIndex:
+    # Alertas ordenadas por target_price: (target_price, alert_id, user_id).
+    # ABOVE salta con precio >= target (prefijo), BELOW con precio <= target (sufijo).
+    def __init__(self):
+        self.loaded = False
+        self._above = []
+        self._below = []
+        self._ids = set()
+        self._lock = threading.Lock()
+
+    def load(self, rows):
+        # rows: (id, user_id, target_price, condition)
+        with self._lock:
+            for alert_id, user_id, target, condition in rows: self._add(alert_id, user_id, target, condition)
+            self.loaded = True
+
+    def add(self, alert_id, user_id, target, condition):
+        with self._lock: self._add(alert_id, user_id, target, condition)
+
+    def _add(self, alert_id, user_id, target, condition):
+        if alert_id in self._ids: return
+        side = self._above if condition == 'ABOVE' else self._below if condition == 'BELOW' else None
+        if side is None: return
+        insort(side, (target, alert_id, user_id))
+        self._ids.add(alert_id)
+
+    def pop_triggered(self, price):
+        with self._lock:
+            cut = bisect_right(self._above, (price, INF))
+            hits = self._above[:cut]
+            del self._above[:cut]
+            cut = bisect_left(self._below, (price, -INF))
+            hits += self._below[cut:]
+            del self._below[cut:]
+            for _, alert_id, _ in hits: self._ids.discard(alert_id)
+        return [(alert_id, user_id, target) for target, alert_id, user_id in hits]
+
+    def __len__(self):
+        return len(self._ids)
+
+# ==============================================================================
+#  VOTOS DEL DÍA
+# ==============================================================================
+class VoteTally:
+    # Votos de un día en memoria: quién votó y contadores UP/DOWN
+    def __init__(self):
+        self.day = None
+        self._voters = set()
+        self._counts = {'UP': 0, 'DOWN': 0}
+        self._lock = threading.Lock()
+
+    def load(self, day, rows):
+        # rows: (user_id, vote_type)
+        with self._lock:
+            self._voters = set()
+            self._counts = {'UP': 0, 'DOWN': 0}
+            for user_id, vote_type in rows: self._add(user_id, vote_type)
+            self.day = day
+
+    def is_for(self, day):
+        return self.day == day
+
+    def has_voted(self, user_id):
+        return user_id in self._voters
+
+    def results(self):
+        with self._lock: return (self._counts['UP'], self._counts['DOWN'])
+
+    def add(self, user_id, vote_type):
+        with self._lock: return self._add(user_id, vote_type)
+
+    def _add(self, user_id, vote_type):
+        if user_id in self._voters: return False
+        self._voters.add(user_id)
+        if vote_type in self._counts: self._counts[vote_type] += 1
+        return True
+
+# ==============================================================================
+#  CONTADOR DIARIO
+# ==============================================================================
+class DailyCounter:
+    # Contador de un día en memoria; al cambiar de día se reinicia y el cierre queda pendiente de guardar
+    def __init__(self):
+        self.day = None
+        self.count = 0
+        self._closed = []
+        self._lock = threading.Lock()
+
+    def seed(self, day, count):
+        with self._lock:
+            if self.day == day: self.count = max(self.count, count)
+            else: self._roll(day, count)
+
+    def incr(self, day, n=1):
+        with self._lock:
+            if self.day != day: self._roll(day, 0)
+            self.count += n
+            return self.count
+
+    def value(self, day):
+        with self._lock: return self.count if self.day == day else 0
+
+    def drain(self):
+        # Días cerrados + el día en curso, para persistir
+        with self._lock:
+            rows = self._closed
+            self._closed = []
+            if self.day is not None: rows.append((self.day, self.count))
+            return rows
+
+    def _roll(self, day, count):
+        if self.day is not None: self._closed.append((self.day, self.count))
+        self.day = day
+        self.count = count
+
+# ==============================================================================
+#  RANKING DE REFERIDOS
+# ==============================================================================
+class Leaderboard:
+    # Solo usuarios con referidos, ordenados por (-referral_count, user_id).
+    # Rango = cuántos tienen más + 1 (bisect); top N = prefijo de la lista
+    def __init__(self):
+        self.loaded = False
+        self._order = []
+        self._scores = {}
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def load(self, rows):
+        # rows: (user_id, first_name, referral_count)
+        with self._lock:
+            self._order = []
+            self._scores = {}
+            self._names = {}
+            for user_id, name, score in rows: self._set(user_id, name, score)
+            self.loaded = True
+
+    def update(self, user_id, name, score):
+        with self._lock: self._set(user_id, name, score)
+
+    def rename(self, user_id, name):
+        with self._lock:
+            if user_id in self._names: self._names[user_id] = name
+
+    def _set(self, user_id, name, score):
+        old = self._scores.pop(user_id, None)
+        if old is not None:
+            i = bisect_left(self._order, (-old, user_id))
+            del self._order[i]
+        self._names.pop(user_id, None)
+        if score and score > 0:
+            insort(self._order, (-score, user_id))
+            self._scores[user_id] = score
+            self._names[user_id] = name
+
+    def score(self, user_id):
+        return self._scores.get(user_id, 0)
+
+    def rank(self, score):
+        with self._lock: return bisect_left(self._order, (-score, -INF)) + 1
+
+    def top(self, n):
+        with self._lock: return [(self._names.get(user_id), -neg) for neg, user_id in self._order[:n]]
+
+    def __len__(self):
+        return len(self._order)
+
+# ==============================================================================
+#  HISTORIAL DE PRECIOS
+# ==============================================================================
+class PriceHistory:
+    # Ring buffer de ticks (ts, buy, sell, bcv) sobre arrays de tamaño fijo: append O(1), sin pop(0).
+    # Por ventana (1h, 6h, 24h...) se mantienen al vuelo el inicio, la suma y colas monótonas
+    # de mín/máx: las estadísticas salen en el tick y los handlers solo leen `stats`.
+    def __init__(self, capacity, windows=(3600, 21600, 86400)):
+        self.capacity = capacity
+        self._ts = array('d', bytes(8 * capacity))
+        self._buy = array('d', bytes(8 * capacity))
+        self._sell = array('d', bytes(8 * capacity))
+        self._bcv = array('d', bytes(8 * capacity))
+        self._next = 0   # Índice lógico del próximo tick (total de ticks agregados)
+        self._windows = {w: {"start": 0, "sum": 0.0, "min": deque(), "max": deque()} for w in windows}
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def append(self, ts, buy, sell=None, bcv=None):
+        with self._lock:
+            cap = self.capacity
+            i = self._next
+            if i: ts = max(ts, self._ts[(i - 1) % cap])   # Reloj que retrocede: no romper el orden
+            slot = i % cap
+            # Antes de pisar el slot: el tick que sale del anillo deja todas las ventanas que lo contengan
+            overwritten = i - cap
+            for state in self._windows.values():
+                if state["start"] <= overwritten:
+                    state["sum"] -= self._buy[slot]
+                    state["start"] = overwritten + 1
+                    if state["min"] and state["min"][0] == overwritten: state["min"].popleft()
+                    if state["max"] and state["max"][0] == overwritten: state["max"].popleft()
+            self._ts[slot], self._buy[slot] = ts, buy
+            self._sell[slot] = NAN if sell is None else sell
+            self._bcv[slot] = NAN if bcv is None else bcv
+            self._next = i + 1
+            stats = {}
+            for window, state in self._windows.items():
+                state["sum"] += buy
+                lows, highs = state["min"], state["max"]
+                while lows and self._buy[lows[-1] % cap] >= buy: lows.pop()
+                lows.append(i)
+                while highs and self._buy[highs[-1] % cap] <= buy: highs.pop()
+                highs.append(i)
+                # Sacar por el inicio lo que salió de la ventana
+                start, horizon = state["start"], ts - window
+                while start < i and self._ts[start % cap] < horizon:
+                    state["sum"] -= self._buy[start % cap]
+                    start += 1
+                state["start"] = start
+                while lows[0] < start: lows.popleft()
+                while highs[0] < start: highs.popleft()
+                first = self._buy[start % cap]
+                samples = i - start + 1
+                span = ts - self._ts[start % cap]
+                stats[window] = {
+                    "change": (buy - first) / first * 100 if first else 0.0,
+                    "min": self._buy[lows[0] % cap], "max": self._buy[highs[0] % cap],
+                    "mean": state["sum"] / samples, "samples": samples, "span": span,
+                    "full": span >= window * 0.9,
+                }
+            self.stats = stats
+
+    def window(self, seconds):
+        return self.stats.get(seconds)
+
+    def latest(self):
+        with self._lock:
+            if not self._next: return None
+            return self._row((self._next - 1) % self.capacity)
+
+    def items(self):
+        # Del más viejo al más nuevo
+        with self._lock:
+            start = max(0, self._next - self.capacity)
+            return [self._row(i % self.capacity) for i in range(start, self._next)]
+
+    def _row(self, slot):
+        sell, bcv = self._sell[slot], self._bcv[slot]
+        return (self._ts[slot], self._buy[slot], None if isnan(sell) else sell, None if isnan(bcv) else bcv)
+
+    def __len__(self):
+        return min(self._next, self.capacity)
@@ -0,0 +1,171 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# ==============================================================================
+#  RENDER DE GRÁFICOS (PROCESO APARTE)
+# ==============================================================================
+# pyplot guarda estado global y no es seguro entre hilos: cada gráfico es una Figure
+# propia y se dibuja en un proceso del pool, fuera del loop del bot.
+# matplotlib se importa solo dentro del render: el proceso del bot nunca lo carga
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "1"))
+
+def _png(fig, **kwargs):
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', **kwargs)
+    return buf.getvalue()
+
+def render_price_chart(data):
+    # data: [(dd/mm, promedio_binance, bcv o None)] en orden de fecha
+    import matplotlib.style
+    from matplotlib.figure import Figure
+    # Estilo oscuro solo dentro del render (no toca el rcParams global)
+    with matplotlib.style.context('dark_background'):
+        dates = [d[0] for d in data]
+        prices_bin = [d[1] for d in data]
+        prices_bcv = [d[2] for d in data]
+        fig = Figure(figsize=(6, 8))
+        ax = fig.subplots()
+        bg_color = '#1e1e1e'
+        fig.patch.set_facecolor(bg_color); ax.set_facecolor(bg_color)
+        ax.plot(dates, prices_bin, color='#F3BA2F', marker='o', linewidth=4, label="Binance")
+        ax.plot(dates, prices_bcv, color='#2979FF', marker='s', linewidth=2, linestyle='--', label="BCV")
+        ax.set_title('TASA BINANCE VZLA', color='#F3BA2F', fontsize=18, fontweight='bold', pad=25)
+        ax.legend(loc="upper center", bbox_to_anchor=(0.5, 1.05), ncol=2, frameon=False)
+        for i, price in enumerate(prices_bin):
+            ax.annotate(f"{price:.2f}", (dates[i], prices_bin[i]), textcoords="offset points", xytext=(0,15), ha='center', color='white', fontsize=11, fontweight='bold')
+        for i, price in enumerate(prices_bcv):
+            if price: ax.annotate(f"{price:.2f}", (dates[i], prices_bcv[i]), textcoords="offset points", xytext=(0,-20), ha='center', color='#2979FF', fontsize=10, fontweight='bold')
+        fig.text(0.5, 0.5, '@tasabinance_bot', fontsize=28, color='white', ha='center', va='center', alpha=0.08, rotation=45, fontweight='bold')
+        fig.tight_layout()
+        return _png(fig, facecolor=bg_color, dpi=100)
+
+def render_stats_chart(growth_data, cmd_data):
+    import matplotlib.style
+    from matplotlib.figure import Figure
+    with matplotlib.style.context('dark_background'):
+        fig = Figure(figsize=(10, 5))
+        ax1, ax2 = fig.subplots(1, 2)
+        bg_color = '#212121'
+        fig.patch.set_facecolor(bg_color)
+        ax1.set_facecolor(bg_color)
+        ax2.set_facecolor(bg_color)
+        if growth_data:
+            dates = [row[0] for row in growth_data]
+            counts = [row[1] for row in growth_data]
+            bars = ax1.bar(dates, counts, color='#F3BA2F')
+            ax1.set_title('Nuevos Usuarios (7 Días)', color='white', fontsize=12)
+            ax1.bar_label(bars, color='white')
+        else: ax1.text(0.5, 0.5, "Sin datos", ha='center', color='gray')
+        if cmd_data:
+            labels = [row[0] for row in cmd_data]
+            sizes = [row[1] for row in cmd_data]
+            ax2.pie(sizes, labels=labels, autopct='%1.1f%%', startangle=90, textprops={'color':"white"})
+            ax2.set_title('Comandos Favoritos', color='white', fontsize=12)
+        else: ax2.text(0.5, 0.5, "Esperando data", ha='center', color='gray')
+        fig.tight_layout()
+        return _png(fig, facecolor=bg_color)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn: el hijo no hereda hilos ni conexiones del bot
+            _executor = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+def _reset_executor(broken):
+    # Un hijo muerto (OOM, segfault) deja el pool roto para siempre: se descarta y se crea otro
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+async def render(fn, *args):
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    try: return await loop.run_in_executor(executor, fn, *args)
+    except BrokenProcessPool:
+        logging.warning("⚠️ Pool de gráficos roto, se recrea")
+        _reset_executor(executor)
+        return await loop.run_in_executor(_get_executor(), fn, *args)
+
+def shutdown_renderer():
+    global _executor
+    with _executor_lock:
+        if _executor is not None: _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+# ==============================================================================
+#  CACHÉ DE GRÁFICOS
+# ==============================================================================
+class ChartCache:
+    # name -> {fingerprint, png, file_id, rendered_at}. La huella son los datos dibujados:
+    # si cambian, el PNG y el file_id de Telegram dejan de valer
+    def __init__(self):
+        self._entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def get(self, name, fingerprint=None):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or (fingerprint is not None and entry["fingerprint"] != fingerprint): return None
+            return dict(entry)
+
+    def put(self, name, fingerprint, png):
+        with self._lock:
+            self._entries[name] = {"fingerprint": fingerprint, "png": png, "file_id": None, "rendered_at": time.time()}
+
+    def set_file_id(self, name, fingerprint, file_id):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and entry["fingerprint"] == fingerprint: entry["file_id"] = file_id
+
+    def touch(self, name, fingerprint):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry and entry["fingerprint"] == fingerprint: entry["rendered_at"] = time.time()
+
+    def export(self):
+        with self._lock: return {name: dict(entry) for name, entry in self._entries.items()}
+
+    def restore(self, entries):
+        # Desde el snapshot de arranque; lo ya dibujado en este proceso manda
+        with self._lock:
+            for name, entry in entries.items(): self._entries.setdefault(name, dict(entry))
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None: self._entries.clear()
+            else: self._entries.pop(name, None)
+
+    async def render(self, name, fingerprint, fn, *args):
+        # Un solo render por (name, huella) aunque lleguen varias peticiones a la vez
+        entry = self.get(name, fingerprint)
+        if entry:
+            # Huella confirmada con datos frescos: cuenta como recién dibujada para max_age
+            self.touch(name, fingerprint)
+            return self.get(name, fingerprint) or entry
+        key = (name, fingerprint)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(render(fn, *args))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        try: png = await asyncio.shield(task)
+        except Exception as e:
+            logging.error(f"Error render {name}: {e}")
+            return None
+        if self.get(name, fingerprint) is None: self.put(name, fingerprint, png)
+        return self.get(name, fingerprint)
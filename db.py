@@ -0,0 +1,194 @@
+import os
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import pool
+from psycopg2.extras import execute_values
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# --- CONFIGURACIÓN POOL ---
+# psycopg2 cierra al devolverlas las conexiones que pasen de DB_POOL_MIN
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "4"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "8"))
+DB_POOL_TIMEOUT = 10      # Segundos esperando una conexión libre
+DB_HEALTHCHECK_IDLE = 60  # Ping si la conexión lleva más de esto sin usarse
+DB_RECONNECT_TRIES = 3
+
+# Canal LISTEN/NOTIFY para avisar al worker de difusiones nuevas
+BROADCAST_CHANNEL = "broadcast_jobs"
+
+_pool = None
+_pool_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_last_used = {}
+
+_CONNECT_KWARGS = dict(
+    keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+    connect_timeout=10, application_name=os.getenv("DB_APP_NAME", "tasabinance")
+)
+
+def _create_pool():
+    return pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, **_CONNECT_KWARGS)
+
+def _get_pool():
+    global _pool
+    if _pool is None or _pool.closed:
+        with _pool_lock:
+            if _pool is None or _pool.closed:
+                _pool = _create_pool()
+                logging.info(f"🗄️ Pool BD listo ({DB_POOL_MIN}-{DB_POOL_MAX})")
+    return _pool
+
+def _is_healthy(conn):
+    if conn.closed: return False
+    if time.monotonic() - _last_used.get(id(conn), 0) < DB_HEALTHCHECK_IDLE: return True
+    try:
+        with conn.cursor() as cur: cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error: return False
+
+def _checkout():
+    last_error = None
+    for attempt in range(DB_RECONNECT_TRIES):
+        try:
+            p = _get_pool()
+            conn = p.getconn()
+        except psycopg2.OperationalError as e:
+            # Postgres caído o reiniciando: reintentar con espera corta
+            last_error = e
+            time.sleep(0.5 * (attempt + 1))
+            continue
+        if _is_healthy(conn): return conn
+        _last_used.pop(id(conn), None)
+        p.putconn(conn, close=True)
+    raise last_error or psycopg2.OperationalError("Sin conexiones sanas en el pool")
+
+def _release(conn, broken=False):
+    p = _pool
+    broken = broken or conn.closed
+    if broken: _last_used.pop(id(conn), None)
+    else: _last_used[id(conn)] = time.monotonic()
+    if p is None or p.closed:
+        if not conn.closed: conn.close()
+        return
+    try: p.putconn(conn, close=broken)
+    except pool.PoolError:
+        if not conn.closed: conn.close()
+
+@contextmanager
+def get_conn():
+    # Conexión prestada del pool: commit al salir, rollback si hay excepción
+    if not _slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise pool.PoolError("Pool BD agotado")
+    conn = None
+    broken = False
+    try:
+        conn = _checkout()
+        yield conn
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        if conn is not None and not conn.closed:
+            try: conn.rollback()
+            except psycopg2.Error: broken = True
+        raise
+    finally:
+        if conn is not None: _release(conn, broken)
+        _slots.release()
+
+@contextmanager
+def get_cursor():
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            yield cur
+
+def connect_listener(channel):
+    # Conexión dedicada (fuera del pool) en autocommit para LISTEN
+    conn = psycopg2.connect(DATABASE_URL, **_CONNECT_KWARGS)
+    conn.autocommit = True
+    with conn.cursor() as cur: cur.execute(f"LISTEN {channel}")
+    return conn
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+            logging.info("🗄️ Pool BD cerrado")
+        _pool = None
+        _last_used.clear()
+
+# ==============================================================================
+#  ESCRITURA DIFERIDA (LOGS)
+# ==============================================================================
+class WriteBehindBuffer:
+    # Acumula filas en RAM y las inserta en bloque desde un hilo propio.
+    # Si la cola está llena se descartan filas nuevas: nunca bloquea al handler.
+    def __init__(self, name, insert_sql, template=None, flush_rows=200, flush_interval=2.0, max_rows=5000):
+        self.name = name
+        self.insert_sql = insert_sql
+        self.template = template
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.dropped = 0
+        self._rows = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def put(self, row):
+        with self._lock:
+            if len(self._rows) >= self.max_rows:
+                self.dropped += 1
+                if self.dropped % 1000 == 1: logging.warning(f"⚠️ Buffer {self.name} lleno, descartando ({self.dropped})")
+                return False
+            self._rows.append(row)
+            pending = len(self._rows)
+        if pending >= self.flush_rows: self._wake.set()
+        return True
+
+    def start(self):
+        if self._thread and self._thread.is_alive(): return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name=f"wb-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        self._stopping = True
+        self._wake.set()
+        if self._thread: self._thread.join(timeout)
+        self.flush()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._rows: return 0
+            batch = list(self._rows)
+            self._rows.clear()
+        try:
+            with get_cursor() as cur:
+                execute_values(cur, self.insert_sql, batch, template=self.template, page_size=1000)
+            return len(batch)
+        except Exception as e:
+            # BD caída: devolver lo que quepa al frente de la cola y descartar el resto
+            with self._lock:
+                room = max(0, self.max_rows - len(self._rows))
+                keep = batch[-room:] if room else []
+                self._rows.extendleft(reversed(keep))
+                self.dropped += len(batch) - len(keep)
+            logging.error(f"Error flush {self.name}: {e}")
+            return 0
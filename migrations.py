@@ -0,0 +1,270 @@
+import logging
+import re
+import time
+from collections import namedtuple
+import psycopg2
+from db import get_conn
+from partitions import ROLLUP_TABLES, convert_to_partitioned
+
+# ==============================================================================
+#  MIGRACIONES VERSIONADAS
+# ==============================================================================
+# Cada paso se aplica una sola vez y queda anotado en schema_version.
+# Pasos nuevos: siempre al final, con la versión siguiente. Nunca editar uno ya publicado.
+# concurrent=True: fuera de transacción (CREATE INDEX CONCURRENTLY no bloquea escrituras)
+# Un paso puede ser SQL o una función que recibe el cursor (DDL que depende del estado)
+Migration = namedtuple("Migration", "version name statements concurrent")
+
+MIGRATION_LOCK = 72001   # pg_advisory_lock: dos despliegues a la vez no migran en paralelo
+
+BASE_TABLES = [
+    """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            first_name TEXT,
+            referral_count INTEGER DEFAULT 0,
+            referred_by BIGINT,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'active',
+            source TEXT 
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS alerts (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            target_price FLOAT,
+            condition TEXT, 
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS activity_logs (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            command TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            date DATE PRIMARY KEY,
+            price_sum FLOAT DEFAULT 0,
+            count INTEGER DEFAULT 0,
+            bcv_price FLOAT DEFAULT 0
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS price_ticks (
+            id SERIAL PRIMARY KEY,
+            price_binance FLOAT,
+            price_bcv FLOAT,
+            recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            price_sell FLOAT,
+            spread_pct FLOAT
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS calc_logs (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT,
+            amount FLOAT,
+            currency_type TEXT,
+            result FLOAT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS daily_requests (
+            day DATE PRIMARY KEY,
+            count INTEGER DEFAULT 0
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS daily_votes (
+            user_id BIGINT,
+            vote_date DATE,
+            vote_type TEXT, 
+            PRIMARY KEY (user_id, vote_date)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS broadcast_queue (
+            id SERIAL PRIMARY KEY,
+            message TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS broadcast_shards (
+            job_id INTEGER,
+            shard INTEGER,
+            shard_count INTEGER,
+            status TEXT DEFAULT 'pending',
+            last_user_id BIGINT DEFAULT 0,
+            stats JSONB DEFAULT '{}'::jsonb,
+            heartbeat_at TIMESTAMP,
+            PRIMARY KEY (job_id, shard)
+        )
+    """,
+    # Presupuesto de envíos por segundo compartido entre workers (no necesita WAL)
+    """
+        CREATE UNLOGGED TABLE IF NOT EXISTS broadcast_rate (
+            slot BIGINT PRIMARY KEY,
+            used INTEGER DEFAULT 0
+        )
+    """,
+    # Tabla Arbitraje (V49)
+    """
+        CREATE TABLE IF NOT EXISTS arbitrage_data (
+            id SERIAL PRIMARY KEY,
+            recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            buy_pm FLOAT,
+            sell_pm FLOAT,
+            buy_banesco FLOAT,
+            buy_mercantil FLOAT,
+            buy_provincial FLOAT,
+            spread_pct FLOAT
+        )
+    """,
+]
+
+# Columnas añadidas a lo largo de las versiones (BDs creadas con esquemas antiguos)
+BASE_COLUMNS = [
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS first_name TEXT",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_count INTEGER DEFAULT 0",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS referred_by BIGINT",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'active'",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS source TEXT",
+    "ALTER TABLE daily_stats ADD COLUMN IF NOT EXISTS bcv_price FLOAT DEFAULT 0",
+    "ALTER TABLE price_ticks ADD COLUMN IF NOT EXISTS price_sell FLOAT",
+    "ALTER TABLE price_ticks ADD COLUMN IF NOT EXISTS spread_pct FLOAT",
+    "ALTER TABLE arbitrage_data ADD COLUMN IF NOT EXISTS spread_pct FLOAT",
+    "ALTER TABLE arbitrage_data ADD COLUMN IF NOT EXISTS sell_banesco FLOAT",
+    "ALTER TABLE arbitrage_data ADD COLUMN IF NOT EXISTS sell_mercantil FLOAT",
+    "ALTER TABLE arbitrage_data ADD COLUMN IF NOT EXISTS sell_provincial FLOAT",
+    # Progreso de difusiones (cursor por user_id para reanudar)
+    "ALTER TABLE broadcast_queue ADD COLUMN IF NOT EXISTS last_user_id BIGINT DEFAULT 0",
+    "ALTER TABLE broadcast_queue ADD COLUMN IF NOT EXISTS stats JSONB DEFAULT '{}'::jsonb",
+    "ALTER TABLE broadcast_queue ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP",
+    "ALTER TABLE broadcast_queue ADD COLUMN IF NOT EXISTS finished_at TIMESTAMP",
+]
+
+MIGRATIONS = [
+    Migration(1, "esquema base", BASE_TABLES + BASE_COLUMNS, False),
+    Migration(2, "acumulado por comando", [
+        """
+            CREATE TABLE IF NOT EXISTS command_stats (
+                command TEXT PRIMARY KEY,
+                count BIGINT DEFAULT 0
+            )
+        """,
+        # Se siembra una vez desde activity_logs
+        """
+            INSERT INTO command_stats (command, count)
+            SELECT command, COUNT(*) FROM activity_logs
+            WHERE command IS NOT NULL AND NOT EXISTS (SELECT 1 FROM command_stats)
+            GROUP BY command
+        """,
+    ], False),
+    Migration(3, "índices de consultas frecuentes", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_activity_logs_created_at ON activity_logs (created_at)",
+        # Destinatarios de difusiones: status = 'active' ordenado por user_id
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_active ON users (user_id) WHERE status = 'active'",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_status ON users (status)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_joined_at ON users (joined_at)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_last_active ON users (last_active)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_referral_count ON users (referral_count DESC)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_alerts_user_id ON alerts (user_id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_alerts_condition_target ON alerts (condition, target_price)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_daily_votes_vote_date ON daily_votes (vote_date)",
+    ], True),
+    Migration(4, "particiones mensuales y agregados", ROLLUP_TABLES + [convert_to_partitioned], False),
+    # Quién tiene cada shard: un shard recuperado deja de aceptar checkpoints del dueño anterior
+    Migration(5, "dueño de shards de difusión", ["ALTER TABLE broadcast_shards ADD COLUMN IF NOT EXISTS owner TEXT"], False),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+_INDEX_NAME = re.compile(r'INDEX CONCURRENTLY IF NOT EXISTS (\w+)')
+
+def _ensure_version_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cur.execute("ALTER TABLE schema_version ADD COLUMN IF NOT EXISTS name TEXT")
+    cur.execute("ALTER TABLE schema_version ADD COLUMN IF NOT EXISTS duration_ms INTEGER")
+
+def _drop_invalid_index(cur, statement):
+    # Un CREATE INDEX CONCURRENTLY interrumpido deja el índice INVALID y IF NOT EXISTS lo saltaría
+    match = _INDEX_NAME.search(statement)
+    if not match: return
+    cur.execute("""
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND NOT i.indisvalid
+    """, (match.group(1),))
+    if cur.fetchone():
+        logging.warning(f"🗄️ Índice {match.group(1)} inválido, se recrea")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}")
+
+def _run(cur, statement):
+    if callable(statement): statement(cur)
+    else: cur.execute(statement)
+
+def _apply(cur, migration):
+    if migration.concurrent:
+        for statement in migration.statements:
+            _drop_invalid_index(cur, statement)
+            _run(cur, statement)
+        cur.execute("BEGIN")
+    else:
+        cur.execute("BEGIN")
+        for statement in migration.statements: _run(cur, statement)
+
+def run_migrations():
+    # -> [(versión, nombre, segundos)] de los pasos aplicados
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+            if cur.fetchone()[0]:
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+                current = cur.fetchone()[0]
+                if current >= LATEST_VERSION:
+                    logging.info(f"🗄️ Esquema al día (v{current}), sin DDL")
+                    return []
+        conn.commit()
+        # autocommit: cada paso abre su transacción, salvo los CONCURRENTLY
+        conn.autocommit = True
+        applied = []
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK,))
+                try:
+                    _ensure_version_table(cur)
+                    cur.execute("SELECT version FROM schema_version")
+                    done = {row[0] for row in cur.fetchall()}
+                    for migration in MIGRATIONS:
+                        if migration.version in done: continue
+                        started = time.perf_counter()
+                        try:
+                            _apply(cur, migration)
+                            elapsed = time.perf_counter() - started
+                            cur.execute("INSERT INTO schema_version (version, name, duration_ms) VALUES (%s, %s, %s)",
+                                        (migration.version, migration.name, int(elapsed * 1000)))
+                            cur.execute("COMMIT")
+                        except Exception:
+                            try: cur.execute("ROLLBACK")
+                            except psycopg2.Error: pass
+                            raise
+                        applied.append((migration.version, migration.name, elapsed))
+                        logging.info(f"🗄️ Migración v{migration.version} ({migration.name}): {elapsed * 1000:.0f} ms")
+                finally:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK,))
+        finally:
+            conn.autocommit = False
+        return applied
@@ -0,0 +1,215 @@
+import logging
+import os
+import re
+import time
+from datetime import date, datetime, timedelta
+from db import get_cursor
+
+# ==============================================================================
+#  PARTICIONES MENSUALES, AGREGADOS Y RETENCIÓN
+# ==============================================================================
+# Las tablas de logs y ticks se parten por mes. La compactación resume las filas
+# crudas en agregados (por día y comando / por hora) y borra las particiones que
+# pasan de la retención, solo si ya están resumidas.
+RAW_RETENTION_DAYS = int(os.getenv("RAW_RETENTION_DAYS", "90"))
+PARTITIONS_AHEAD = 2          # Meses creados por adelantado
+ROLLUP_LAG_MINUTES = 10       # Margen para filas que llegan tarde desde el buffer de logs
+PURGE_BATCH = 50000
+
+# tabla -> columna de tiempo
+PARTITIONED = {
+    "activity_logs": "created_at",
+    "calc_logs": "created_at",
+    "arbitrage_data": "recorded_at",
+}
+
+ROLLUP_TABLES = [
+    """
+        CREATE TABLE IF NOT EXISTS activity_daily (
+            day DATE,
+            command TEXT,
+            count BIGINT DEFAULT 0,
+            PRIMARY KEY (day, command)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS calc_daily (
+            day DATE,
+            currency_type TEXT,
+            count BIGINT DEFAULT 0,
+            amount_sum FLOAT DEFAULT 0,
+            result_sum FLOAT DEFAULT 0,
+            PRIMARY KEY (day, currency_type)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS arbitrage_hourly (
+            hour TIMESTAMP PRIMARY KEY,
+            samples INTEGER,
+            buy_pm_avg FLOAT, buy_pm_min FLOAT, buy_pm_max FLOAT,
+            sell_pm_avg FLOAT,
+            spread_pct_avg FLOAT,
+            buy_banesco_avg FLOAT, buy_mercantil_avg FLOAT, buy_provincial_avg FLOAT,
+            sell_banesco_avg FLOAT, sell_mercantil_avg FLOAT, sell_provincial_avg FLOAT
+        )
+    """,
+    # Hasta dónde llegó cada agregado: cada tramo se resume una sola vez
+    """
+        CREATE TABLE IF NOT EXISTS rollup_state (
+            name TEXT PRIMARY KEY,
+            rolled_until TIMESTAMP
+        )
+    """,
+]
+
+# nombre -> (tabla origen, unidad, INSERT ... SELECT sobre [since, until))
+ROLLUPS = {
+    "activity_daily": ("activity_logs", "day", """
+        INSERT INTO activity_daily (day, command, count)
+        SELECT created_at::date, COALESCE(command, ''), COUNT(*) FROM activity_logs
+        WHERE created_at >= %(since)s AND created_at < %(until)s
+        GROUP BY 1, 2
+        ON CONFLICT (day, command) DO UPDATE SET count = activity_daily.count + EXCLUDED.count
+    """),
+    "calc_daily": ("calc_logs", "day", """
+        INSERT INTO calc_daily (day, currency_type, count, amount_sum, result_sum)
+        SELECT created_at::date, COALESCE(currency_type, ''), COUNT(*), COALESCE(SUM(amount), 0), COALESCE(SUM(result), 0) FROM calc_logs
+        WHERE created_at >= %(since)s AND created_at < %(until)s
+        GROUP BY 1, 2
+        ON CONFLICT (day, currency_type) DO UPDATE SET
+            count = calc_daily.count + EXCLUDED.count,
+            amount_sum = calc_daily.amount_sum + EXCLUDED.amount_sum,
+            result_sum = calc_daily.result_sum + EXCLUDED.result_sum
+    """),
+    "arbitrage_hourly": ("arbitrage_data", "hour", """
+        INSERT INTO arbitrage_hourly
+        SELECT date_trunc('hour', recorded_at), COUNT(*),
+               AVG(buy_pm), MIN(buy_pm), MAX(buy_pm), AVG(sell_pm), AVG(spread_pct),
+               AVG(buy_banesco), AVG(buy_mercantil), AVG(buy_provincial),
+               AVG(sell_banesco), AVG(sell_mercantil), AVG(sell_provincial)
+        FROM arbitrage_data
+        WHERE recorded_at >= %(since)s AND recorded_at < %(until)s
+        GROUP BY 1
+        ON CONFLICT (hour) DO NOTHING
+    """),
+}
+
+_UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+def _month_start(day):
+    return date(day.year, day.month, 1)
+
+def _next_month(day):
+    return date(day.year + (day.month == 12), day.month % 12 + 1, 1)
+
+def convert_to_partitioned(cur):
+    # Migración: la tabla actual pasa a ser la partición "legacy" (hasta fin de este mes)
+    next_month = _next_month(date.today())
+    for table, column in PARTITIONED.items():
+        cur.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relnamespace = 'public'::regnamespace", (table,))
+        row = cur.fetchone()
+        if row and row[0] == 'p': continue
+        legacy = f"{table}_p_legacy"
+        cur.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        cur.execute(f"ALTER INDEX IF EXISTS idx_{table}_{column} RENAME TO idx_{legacy}_{column}")
+        cur.execute(f"UPDATE {legacy} SET {column} = 'epoch' WHERE {column} IS NULL")
+        cur.execute(f"ALTER TABLE {legacy} ALTER COLUMN {column} SET NOT NULL")
+        # La PK de una tabla particionada debe incluir la columna de partición: (id, columna)
+        cur.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'", (legacy,))
+        for (constraint,) in cur.fetchall(): cur.execute(f"ALTER TABLE {legacy} DROP CONSTRAINT {constraint}")
+        # Mismas columnas y defaults (el id sigue usando la misma secuencia)
+        cur.execute(f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE ({column})")
+        cur.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id, {column})")
+        cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO (%s)", (next_month,))
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} ({column})")
+        cur.execute(f"SELECT pg_get_serial_sequence('{legacy}', 'id')")
+        sequence = cur.fetchone()[0]
+        # Que la secuencia no desaparezca al borrar la partición legacy
+        if sequence: cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+        # Red de seguridad si el job no creó a tiempo la partición del mes
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_p_default PARTITION OF {table} DEFAULT")
+        logging.info(f"🗂️ {table} particionada por mes ({column})")
+    ensure_partitions(cur)
+
+def ensure_partitions(cur, months_ahead=PARTITIONS_AHEAD):
+    created = 0
+    for table in PARTITIONED:
+        month = _month_start(date.today())
+        for _ in range(months_ahead + 1):
+            following = _next_month(month)
+            name = f"{table}_p{month:%Y%m}"
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+            if cur.fetchone()[0]:
+                month = following
+                continue
+            cur.execute("SAVEPOINT partition")
+            try:
+                cur.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", (month, following))
+                cur.execute("RELEASE SAVEPOINT partition")
+                created += 1
+            except Exception as e:
+                # Ya cubierto por la partición legacy (o datos en la DEFAULT para ese mes)
+                cur.execute("ROLLBACK TO SAVEPOINT partition")
+                if "overlap" not in str(e): logging.error(f"Error creando {name}: {e}")
+            month = following
+    return created
+
+def _rollup(cur, name):
+    source, unit, sql = ROLLUPS[name]
+    cur.execute(f"SELECT date_trunc('{unit}', NOW() - INTERVAL '{ROLLUP_LAG_MINUTES} minutes')::timestamp")
+    until = cur.fetchone()[0]
+    cur.execute("SELECT rolled_until FROM rollup_state WHERE name = %s FOR UPDATE", (name,))
+    row = cur.fetchone()
+    since = row[0] if row and row[0] else datetime.min
+    if since >= until: return until
+    cur.execute(sql, {"since": since, "until": until})
+    cur.execute("""
+        INSERT INTO rollup_state (name, rolled_until) VALUES (%s, %s)
+        ON CONFLICT (name) DO UPDATE SET rolled_until = EXCLUDED.rolled_until
+    """, (name, until))
+    return until
+
+def _partitions(cur, table):
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+    """, (table,))
+    return cur.fetchall()
+
+def _expire(table, column, cutoff):
+    # Cada DROP y cada lote de DELETE en su propia transacción: sin locks ni WAL acumulados
+    dropped, purged = [], 0
+    with get_cursor() as cur: partitions = _partitions(cur, table)
+    for name, bound in partitions:
+        upper = _UPPER_BOUND.search(bound or "")
+        if upper and datetime.fromisoformat(upper.group(1)) <= cutoff:
+            with get_cursor() as cur: cur.execute(f"DROP TABLE {name}")
+            dropped.append(name)
+        elif "MINVALUE" in (bound or "") or bound == "DEFAULT":
+            # Legacy/DEFAULT abarcan meses mezclados: borrar por lotes solo lo vencido
+            while True:
+                with get_cursor() as cur:
+                    cur.execute(f"DELETE FROM {name} WHERE ctid IN (SELECT ctid FROM {name} WHERE {column} < %s LIMIT %s)", (cutoff, PURGE_BATCH))
+                    deleted = cur.rowcount
+                purged += deleted
+                if deleted < PURGE_BATCH: break
+    return dropped, purged
+
+def compact_storage(retention_days=RAW_RETENTION_DAYS):
+    # Job diario: particiones futuras -> agregados -> borrar lo vencido y ya resumido
+    started = time.perf_counter()
+    summary = {}
+    with get_cursor() as cur:
+        summary["particiones"] = ensure_partitions(cur)
+    rolled = {}
+    for name in ROLLUPS:
+        with get_cursor() as cur: rolled[ROLLUPS[name][0]] = _rollup(cur, name)
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    for table, column in PARTITIONED.items():
+        # Nunca borrar filas que aún no entraron en su agregado
+        table_cutoff = min(cutoff, rolled.get(table, cutoff))
+        dropped, purged = _expire(table, column, table_cutoff)
+        summary[table] = (len(dropped), purged)
+    logging.info(f"🗂️ Compactación en {time.perf_counter() - started:.2f}s: {summary}")
+    return summary
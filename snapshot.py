@@ -0,0 +1,57 @@
+import base64
+import gzip
+import json
+import logging
+import os
+import time
+
+# ==============================================================================
+#  SNAPSHOT LOCAL DEL MERCADO (ARRANQUE EN CALIENTE)
+# ==============================================================================
+# JSON comprimido, escrito en un temporal y renombrado: un corte a mitad de escritura
+# nunca deja un archivo a medias. Los PNG van en base64.
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "market_snapshot.json.gz")
+SNAPSHOT_VERSION = 1
+SNAPSHOT_MAX_AGE = 86400   # Más viejo que esto no se sirve
+
+def _tuples(value):
+    # JSON no tiene tuplas: las huellas de gráficos se comparan como tuplas
+    if isinstance(value, list): return tuple(_tuples(v) for v in value)
+    return value
+
+def _encode_charts(charts):
+    encoded = {}
+    for name, entry in charts.items():
+        try:
+            json.dumps(entry["fingerprint"])
+        except TypeError: continue   # Huella con fechas u otros tipos: se vuelve a dibujar
+        encoded[name] = dict(entry, png=base64.b64encode(entry["png"]).decode("ascii"))
+    return encoded
+
+def _decode_charts(charts):
+    return {name: dict(entry, png=base64.b64decode(entry["png"]), fingerprint=_tuples(entry["fingerprint"])) for name, entry in charts.items()}
+
+def save_snapshot(state, path=SNAPSHOT_PATH):
+    # state: price, bcv, last_updated, history [(ts, buy, sell, bcv)], charts {name: entry}
+    payload = dict(state, version=SNAPSHOT_VERSION, saved_at=time.time(), charts=_encode_charts(state.get("charts", {})))
+    tmp = f"{path}.tmp"
+    try:
+        with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=5) as f: json.dump(payload, f, separators=(",", ":"))
+        os.replace(tmp, path)
+        return True
+    except Exception as e:
+        logging.error(f"Error guardando snapshot: {e}")
+        return False
+
+def load_snapshot(path=SNAPSHOT_PATH, max_age=SNAPSHOT_MAX_AGE):
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f: payload = json.load(f)
+    except FileNotFoundError: return None
+    except Exception as e:
+        logging.warning(f"⚠️ Snapshot ilegible, se ignora: {e}")
+        return None
+    if payload.get("version") != SNAPSHOT_VERSION: return None
+    if time.time() - payload.get("saved_at", 0) > max_age: return None
+    payload["history"] = [tuple(row) for row in payload.get("history", [])]
+    payload["charts"] = _decode_charts(payload.get("charts", {}))
+    return payload
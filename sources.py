@@ -0,0 +1,324 @@
+import asyncio
+import hashlib
+import logging
+import random
+import re
+import time
+from datetime import datetime
+import httpx
+import pytz
+
+# ==============================================================================
+#  FUENTES DE PRECIO (HTTP ASÍNCRONO)
+# ==============================================================================
+BINANCE_URL = "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search"
+BCV_URL = "http://www.bcv.org.ve/"
+FILTER_MIN_USD = 20
+PAY_TYPES = ["PagoMovil", "Banesco", "Mercantil", "Provincial"]
+MAIN_PAY_TYPE = "PagoMovil"
+
+# Timeouts por fuente y plazo total del tick (segundos)
+BINANCE_TIMEOUT = 10
+BCV_TIMEOUT = 30
+TICK_DEADLINE = 40
+
+# Limitador del abanico de bancos: peticiones simultáneas y espera aleatoria previa
+BINANCE_CONCURRENCY = 3
+BINANCE_JITTER = (0.05, 0.4)
+
+# Lista Anti-Ban
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/115.0",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1"
+]
+BCV_USER_AGENT = USER_AGENTS[0]
+
+# Sondeo adaptativo del BCV: la tasa cambia ~1 vez al día, en horario de tarde
+BCV_TZ = pytz.timezone('America/Caracas')
+BCV_WINDOW_HOURS = (15, 19)   # Ventana habitual de publicación (lun-vie)
+BCV_WINDOW_INTERVAL = 300     # Dentro de la ventana, hasta ver la tasa nueva
+BCV_IDLE_INTERVAL = 3600      # Fuera de la ventana o con la tasa del día ya vista
+BCV_STATE = {"etag": None, "last_modified": None, "hash": None, "rates": None, "published_on": None, "next_check": 0.0}
+
+# ==============================================================================
+#  CORTACIRCUITOS POR FUENTE
+# ==============================================================================
+# closed: todo pasa. Tras BREAKER_THRESHOLD fallos seguidos -> open: no se llama a la fuente
+# durante el backoff (se duplica en cada apertura, con tope). Al vencer -> half_open: una
+# sola sonda; si responde se cierra, si no se vuelve a abrir con el doble de espera.
+BREAKER_THRESHOLD = 3
+BREAKER_BASE_BACKOFF = 30
+BREAKER_MAX_BACKOFF = 900
+BREAKER_PROBE_TIMEOUT = 60   # Una sonda cancelada (plazo del tick) no deja el circuito trabado
+
+class CircuitBreaker:
+    def __init__(self, name, threshold=BREAKER_THRESHOLD, base_backoff=BREAKER_BASE_BACKOFF, max_backoff=BREAKER_MAX_BACKOFF):
+        self.name = name
+        self.threshold = threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0             # Aperturas seguidas sin recuperarse (exponente del backoff)
+        self.retry_at = 0.0
+        self.probing = False
+        self.probe_started = 0.0
+        self.last_error = None
+        self.last_success = None   # Epoch del último dato bueno
+        self.last_failure = None
+
+    def allow(self):
+        if self.state == "closed": return True
+        if self.state == "open":
+            if time.monotonic() < self.retry_at: return False
+            self.state = "half_open"
+            self.probing = False
+        # half_open: deja pasar una sola sonda a la vez
+        if self.probing and time.monotonic() - self.probe_started < BREAKER_PROBE_TIMEOUT: return False
+        self.probing = True
+        self.probe_started = time.monotonic()
+        return True
+
+    def success(self):
+        if self.state != "closed": logging.info(f"✅ {self.name}: fuente recuperada tras {self.trips} aperturas")
+        self.state = "closed"
+        self.failures = 0
+        self.trips = 0
+        self.probing = False
+        self.last_success = time.time()
+
+    def failure(self, error):
+        self.failures += 1
+        self.last_error = str(error)[:200]
+        self.last_failure = time.time()
+        if self.state == "open": return
+        if self.state == "half_open" or self.failures >= self.threshold:
+            backoff = min(self.max_backoff, self.base_backoff * 2 ** self.trips)
+            backoff *= random.uniform(0.8, 1.2)   # Sin sincronizar reintentos entre réplicas
+            self.trips += 1
+            self.state = "open"
+            self.probing = False
+            self.retry_at = time.monotonic() + backoff
+            logging.warning(f"⚠️ {self.name}: circuito abierto {backoff:.0f}s ({self.failures} fallos, {self.last_error})")
+
+    def health(self):
+        now = time.time()
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_in": max(0, round(self.retry_at - time.monotonic())) if self.state == "open" else 0,
+            "last_success_age": round(now - self.last_success) if self.last_success else None,
+            "last_error": self.last_error,
+        }
+
+BREAKERS = {"binance": CircuitBreaker("Binance"), "bcv": CircuitBreaker("BCV")}
+
+def source_health():
+    # Para monitoreo (/fuentes): estado del circuito y edad del último dato bueno por fuente
+    return {name: breaker.health() for name, breaker in BREAKERS.items()}
+
+# Sesiones persistentes (keep-alive), se crean en el loop que las usa
+_clients = {}
+
+def _client(name):
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        limits = httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=120)
+        if name == "bcv":
+            # El certificado del BCV suele estar roto
+            client = httpx.AsyncClient(verify=False, limits=limits, timeout=BCV_TIMEOUT, follow_redirects=True)
+        else:
+            client = httpx.AsyncClient(limits=limits, timeout=BINANCE_TIMEOUT)
+        _clients[name] = client
+    return client
+
+async def close_sessions():
+    for client in list(_clients.values()):
+        if not client.is_closed: await client.aclose()
+    _clients.clear()
+
+# --- BINANCE P2P ---
+async def fetch_binance_raw(trade_type, bank_filter=None, last_price=None):
+    ua = random.choice(USER_AGENTS)
+    headers = {"Content-Type": "application/json", "User-Agent": ua}
+    last_known = last_price if last_price else 600
+    safe_amount = max(2000, min(int(last_known * FILTER_MIN_USD), 20000))
+    pay_types = [bank_filter] if bank_filter else PAY_TYPES
+    payload = {
+        "page": 1, "rows": 3,
+        "payTypes": pay_types,
+        "publisherType": "merchant",
+        "transAmount": str(safe_amount),
+        "asset": "USDT", "fiat": "VES", "tradeType": trade_type
+    }
+    client = _client("binance")
+    breaker = BREAKERS["binance"]
+    try:
+        response = await client.post(BINANCE_URL, json=payload, headers=headers)
+        if response.status_code != 200: raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request, response=response)
+        data = response.json()
+        if not data.get("data"):
+            del payload["publisherType"]
+            response = await client.post(BINANCE_URL, json=payload, headers=headers)
+            if response.status_code != 200: raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request, response=response)
+            data = response.json()
+        prices = [float(item["adv"]["price"]) for item in data.get("data", [])]
+        # Sin anuncios para ese filtro no es un fallo de la fuente
+        breaker.success()
+        return sum(prices) / len(prices) if prices else None
+    except Exception as e:
+        breaker.failure(e)
+        return None
+
+# --- BCV ---
+# Ruta rápida: buscar solo div#dolar / div#euro y su primer <strong>, sin construir el árbol
+_BCV_BLOCK = re.compile(rb'''id\s*=\s*["']?(dolar|euro)["'\s>]''')
+_BCV_STRONG = re.compile(rb'<strong[^>]*>\s*([^<]+?)\s*</strong>', re.I)
+_BCV_STRONG_LOOKAHEAD = 4000
+_DIV_TAG = re.compile(rb'<(/?)div\b', re.I)
+
+def _bcv_block_end(content, start):
+    # Cierre del div de la moneda (contando divs anidados): el <strong> se busca solo dentro
+    depth, limit = 1, start + _BCV_STRONG_LOOKAHEAD
+    for tag in _DIV_TAG.finditer(content, start, limit):
+        depth += -1 if tag.group(1) else 1
+        if depth == 0: return tag.start()
+    return limit
+
+def extract_bcv_fast(content):
+    rates = {'usd': None, 'eur': None}
+    for block in _BCV_BLOCK.finditer(content):
+        # Descartar data-id=, grid=... (un lookbehind en el patrón lo hace 20x más lento)
+        prev = content[block.start() - 1:block.start()]
+        if prev.isalnum() or prev in (b'-', b'_'): continue
+        key = 'usd' if block.group(1) == b'dolar' else 'eur'
+        if rates[key] is not None: continue
+        # Sin <strong> en su propio bloque: None y que decida BeautifulSoup (nunca el de la moneda vecina)
+        strong = _BCV_STRONG.search(content, block.end(), _bcv_block_end(content, block.end()))
+        if not strong: return None
+        try: rates[key] = float(strong.group(1).decode('latin-1').strip().replace(',', '.'))
+        except ValueError: return None
+        if rates['usd'] is not None and rates['eur'] is not None: break
+    return rates if rates['usd'] is not None else None
+
+def parse_bcv_html(content):
+    # Respaldo lento; bs4 se importa solo si hace falta
+    from bs4 import BeautifulSoup
+    rates = {'usd': None, 'eur': None}
+    soup = BeautifulSoup(content, 'html.parser')
+    dolar = soup.find('div', id='dolar')
+    if dolar: rates['usd'] = float(dolar.find('strong').text.strip().replace(',', '.'))
+    euro = soup.find('div', id='euro')
+    if euro: rates['eur'] = float(euro.find('strong').text.strip().replace(',', '.'))
+    return rates
+
+def _bcv_next_interval(now_local):
+    if BCV_STATE["rates"] is None: return 0
+    start, end = BCV_WINDOW_HOURS
+    weekday = now_local.weekday() < 5
+    if weekday and start <= now_local.hour < end and BCV_STATE["published_on"] != now_local.date():
+        return BCV_WINDOW_INTERVAL
+    interval = BCV_IDLE_INTERVAL
+    if weekday and now_local.hour < start:
+        # No dormir más allá del inicio de la ventana
+        window_open = now_local.replace(hour=start, minute=0, second=0, microsecond=0)
+        interval = min(interval, (window_open - now_local).total_seconds())
+    return interval
+
+def _bcv_cached():
+    return dict(BCV_STATE["rates"]) if BCV_STATE["rates"] else None
+
+async def fetch_bcv_price():
+    if BCV_STATE["rates"] and time.monotonic() < BCV_STATE["next_check"]:
+        return _bcv_cached()
+    breaker = BREAKERS["bcv"]
+    # Circuito abierto: ni esperar los 30s del timeout, se sirve la última tasa buena
+    if not breaker.allow(): return _bcv_cached()
+    headers = {"User-Agent": BCV_USER_AGENT}
+    if BCV_STATE["etag"]: headers["If-None-Match"] = BCV_STATE["etag"]
+    if BCV_STATE["last_modified"]: headers["If-Modified-Since"] = BCV_STATE["last_modified"]
+    try:
+        response = await _client("bcv").get(BCV_URL, headers=headers)
+        if response.status_code not in (200, 304): raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request, response=response)
+        breaker.success()
+        if response.status_code == 304: return _bcv_cached()
+        if response.status_code == 200:
+            BCV_STATE["etag"] = response.headers.get("ETag")
+            BCV_STATE["last_modified"] = response.headers.get("Last-Modified")
+            digest = hashlib.sha1(response.content).hexdigest()
+            if digest == BCV_STATE["hash"] and BCV_STATE["rates"]: return _bcv_cached()
+            # Ruta rápida en el loop; el árbol completo (CPU pura) solo si falla, y en un hilo
+            rates = extract_bcv_fast(response.content)
+            if rates is None:
+                logging.warning("⚠️ BCV: extractor rápido falló, usando BeautifulSoup")
+                rates = await asyncio.to_thread(parse_bcv_html, response.content)
+            if not rates['usd']: return None
+            previous = BCV_STATE["rates"]
+            if previous and previous != rates: BCV_STATE["published_on"] = datetime.now(BCV_TZ).date()
+            BCV_STATE["hash"] = digest
+            BCV_STATE["rates"] = rates
+            if rates != previous: logging.info(f"✅ BCV: {rates['usd']}")
+            return dict(rates)
+    except asyncio.CancelledError:
+        # Petición colgada cortada por el plazo exterior (BCV_TIMEOUT o fin del tick): también cuenta
+        breaker.failure("timeout")
+        raise
+    except Exception as e:
+        breaker.failure(e)
+        logging.error(f"❌ BCV Error: {e}")
+    finally:
+        BCV_STATE["next_check"] = time.monotonic() + _bcv_next_interval(datetime.now(BCV_TZ))
+    return None
+
+# --- RECOLECCIÓN CONCURRENTE ---
+async def _with_timeout(aw, timeout):
+    try: return await asyncio.wait_for(aw, max(0, timeout))
+    except asyncio.TimeoutError: return None
+
+def tick_deadline():
+    return asyncio.get_running_loop().time() + TICK_DEADLINE
+
+async def until_deadline(aw, deadline):
+    return await _with_timeout(aw, deadline - asyncio.get_running_loop().time())
+
+async def _fetch_limited(limiter, trade_type, bank, last_price):
+    async with limiter:
+        # Si el circuito se abrió mientras esperaba turno, no salir a la red
+        if BREAKERS["binance"].state == "open": return None
+        await asyncio.sleep(random.uniform(*BINANCE_JITTER))
+        try: return await asyncio.wait_for(fetch_binance_raw(trade_type, bank, last_price), BINANCE_TIMEOUT)
+        except asyncio.TimeoutError:
+            BREAKERS["binance"].failure("timeout")
+            return None
+
+async def collect_binance(last_price=None, pay_types=PAY_TYPES, limiter=None):
+    # BUY/SELL de cada banco en paralelo, como mucho BINANCE_CONCURRENCY a la vez
+    snapshot = {bank: {"buy": None, "sell": None} for bank in pay_types}
+    breaker = BREAKERS["binance"]
+    if not breaker.allow(): return snapshot
+    limiter = limiter or asyncio.Semaphore(BINANCE_CONCURRENCY)
+    jobs = [(bank, trade_type) for bank in pay_types for trade_type in ("BUY", "SELL")]
+    if breaker.state == "half_open":
+        # Sonda: solo la primera petición; el abanico completo si la fuente respondió
+        bank, trade_type = jobs[0]
+        snapshot[bank][trade_type.lower()] = await _fetch_limited(limiter, trade_type, bank, last_price)
+        if breaker.state != "closed": return snapshot
+        jobs = jobs[1:]
+    results = await asyncio.gather(*(_fetch_limited(limiter, trade_type, bank, last_price) for bank, trade_type in jobs))
+    for (bank, trade_type), price in zip(jobs, results): snapshot[bank][trade_type.lower()] = price
+    return snapshot
+
+def start_binance_collect(last_price=None):
+    # -> (tarea del banco principal, tarea del resto). Comparten el limitador y la del principal
+    # se crea antes (el semáforo atiende en orden): su precio se publica sin esperar a los demás
+    limiter = asyncio.Semaphore(BINANCE_CONCURRENCY)
+    main = asyncio.create_task(collect_binance(last_price, [MAIN_PAY_TYPE], limiter))
+    rest = asyncio.create_task(collect_binance(last_price, [bank for bank in PAY_TYPES if bank != MAIN_PAY_TYPE], limiter))
+    return main, rest
+
+def start_bcv_fetch():
+    # Corre en paralelo a Binance; el tick la espera solo hasta su plazo
+    return asyncio.create_task(_with_timeout(fetch_bcv_price(), BCV_TIMEOUT))
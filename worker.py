@@ -1,10 +1,17 @@
 import os
 import logging
-import psycopg2
 import asyncio
 import time
+import uuid
+import multiprocessing
+from collections import Counter
 from telegram import Bot
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+from telegram.request import HTTPXRequest
+import psycopg2
+from psycopg2.extras import Json
+from db import get_cursor, close_pool, connect_listener, BROADCAST_CHANNEL
 
 logging.basicConfig(format='%(asctime)s - WORKER - %(message)s', level=logging.INFO)
 
@@ -12,75 +19,390 @@ TOKEN = os.getenv("TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "533888411"))
 
-async def get_all_users():
-    conn = psycopg2.connect(DATABASE_URL)
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM users WHERE status = 'active'")
-    users = [row[0] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
-    return users
+# --- LÍMITES TELEGRAM ---
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # msg/seg (Telegram tolera ~30 en global)
+BROADCAST_BURST = 5
+MAX_IN_FLIGHT = 20
+MAX_RETRIES = 3
+
+# --- CHECKPOINTS ---
+CHUNK_SIZE = 200          # Destinatarios por checkpoint (lo máximo que se reenvía tras un crash)
+STALE_AFTER_MIN = 10      # Un trabajo 'processing' sin latido en este tiempo se da por huérfano
+POLL_FALLBACK = 30        # Sondeo de respaldo si se pierde un NOTIFY o no hay LISTEN
+HEARTBEAT_EVERY = 60      # Latido mientras se envía (aunque un RetryAfter largo frene el bloque)
+
+# --- SHARDS ---
+BROADCAST_SHARDS = int(os.getenv("BROADCAST_SHARDS", "4"))   # Cada trabajo se parte por user_id % N
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))   # Procesos lanzados por este worker.py
+BUDGET_LEASE = 5          # Tokens que reserva cada proceso por consulta al presupuesto compartido
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        # Flood control: nadie envía hasta que pase el RetryAfter
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class SharedBudget:
+    # Presupuesto global en Postgres: todos los procesos reservan lotes del segundo en curso,
+    # así la suma de envíos no pasa de BROADCAST_RATE aunque haya varios workers
+    def __init__(self, rate, lease=BUDGET_LEASE):
+        self.limit = int(rate)
+        self.lease = min(lease, self.limit)
+        self.tokens = 0
+        self.expires = 0.0
+        self.lock = asyncio.Lock()
+
+    def _lease(self):
+        # -> (concedido, segundos que le quedan al slot según el reloj de Postgres)
+        with get_cursor() as cur:
+            cur.execute("""
+                WITH now AS (SELECT EXTRACT(EPOCH FROM clock_timestamp()) AS t),
+                lease AS (
+                    INSERT INTO broadcast_rate (slot, used)
+                    SELECT FLOOR(t), %(n)s FROM now
+                    ON CONFLICT (slot) DO UPDATE SET used = broadcast_rate.used + %(n)s
+                    WHERE broadcast_rate.used + %(n)s <= %(limit)s
+                    RETURNING slot
+                )
+                SELECT EXISTS (SELECT 1 FROM lease), (FLOOR(t) + 1 - t)::float FROM now
+            """, {"n": self.lease, "limit": self.limit})
+            return cur.fetchone()
+
+    def _pause(self, seconds):
+        # Flood control para todos los procesos: los slots de la pausa quedan llenos
+        with get_cursor() as cur:
+            cur.execute("""
+                INSERT INTO broadcast_rate (slot, used)
+                SELECT s, %(limit)s FROM generate_series(
+                    FLOOR(EXTRACT(EPOCH FROM clock_timestamp()))::bigint,
+                    CEIL(EXTRACT(EPOCH FROM clock_timestamp()) + %(secs)s)::bigint - 1) s
+                ON CONFLICT (slot) DO UPDATE SET used = GREATEST(broadcast_rate.used, EXCLUDED.used)
+            """, {"limit": self.limit, "secs": seconds})
+
+    async def pause(self, seconds):
+        self.tokens = 0
+        try: await asyncio.to_thread(self._pause, seconds)
+        except Exception as e: logging.error(f"Error pausando presupuesto compartido: {e}")
+
+    async def acquire(self):
+        async with self.lock:
+            # Los tokens reservados caducan con su slot (segundo de Postgres), no un segundo después del lease
+            if time.monotonic() >= self.expires: self.tokens = 0
+            while self.tokens <= 0:
+                try: granted, remaining = await asyncio.to_thread(self._lease)
+                except Exception as e:
+                    logging.error(f"Error presupuesto compartido (solo límite local): {e}")
+                    return
+                if granted:
+                    self.tokens = self.lease
+                    self.expires = time.monotonic() + remaining
+                else: await asyncio.sleep(remaining + 0.01)   # Slot lleno (o en pausa): esperar al siguiente
+            self.tokens -= 1
+
+def get_users_after(last_user_id, shard=0, shard_count=1, limit=CHUNK_SIZE):
+    # Paginación por user_id dentro del shard: el cursor guardado marca hasta dónde se llegó
+    with get_cursor() as cur:
+        cur.execute("""
+            SELECT user_id FROM users
+            WHERE status = 'active' AND user_id > %s AND user_id %% %s = %s
+            ORDER BY user_id LIMIT %s
+        """, (last_user_id, shard_count, shard, limit))
+        return [row[0] for row in cur.fetchall()]
+
+def reclaim_stale_jobs():
+    with get_cursor() as cur:
+        cur.execute(f"""
+            UPDATE broadcast_shards SET status = 'pending'
+            WHERE status = 'processing'
+              AND (heartbeat_at IS NULL OR heartbeat_at < NOW() - INTERVAL '{STALE_AFTER_MIN} minutes')
+            RETURNING job_id, shard, last_user_id
+        """)
+        for job_id, shard, last_user_id in cur.fetchall():
+            logging.warning(f"♻️ Trabajo #{job_id} shard {shard} recuperado (reanuda tras user_id {last_user_id})")
+        # Trabajos huérfanos de antes de los shards: vuelven a la cola con su cursor
+        cur.execute(f"""
+            UPDATE broadcast_queue q SET status = 'pending'
+            WHERE status = 'processing'
+              AND NOT EXISTS (SELECT 1 FROM broadcast_shards s WHERE s.job_id = q.id)
+              AND (heartbeat_at IS NULL OR heartbeat_at < NOW() - INTERVAL '{STALE_AFTER_MIN} minutes')
+            RETURNING id, last_user_id
+        """)
+        for job_id, last_user_id in cur.fetchall():
+            logging.warning(f"♻️ Trabajo #{job_id} recuperado (reanuda tras user_id {last_user_id})")
+
+def expand_pending_job():
+    with get_cursor() as cur:
+        # Tomar un trabajo pendiente y partirlo en shards en una sentencia; SKIP LOCKED evita duplicados
+        cur.execute("""
+            WITH job AS (
+                UPDATE broadcast_queue SET status = 'processing', heartbeat_at = NOW()
+                WHERE id = (
+                    SELECT id FROM broadcast_queue WHERE status = 'pending'
+                    ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, last_user_id
+            )
+            INSERT INTO broadcast_shards (job_id, shard, shard_count, last_user_id)
+            SELECT job.id, g, %(n)s, job.last_user_id FROM job, generate_series(0, %(n)s - 1) g
+            ON CONFLICT (job_id, shard) DO UPDATE SET status = 'pending'
+            RETURNING job_id
+        """, {"n": max(1, BROADCAST_SHARDS)})
+        row = cur.fetchone()
+        if row:
+            # Despertar a los demás workers para que tomen los otros shards
+            cur.execute("SELECT pg_notify(%s, %s)", (BROADCAST_CHANNEL, str(row[0])))
+            return row[0]
+
+def claim_shard():
+    # Cada toma lleva su propio token: si el shard se recupera, el dueño anterior ya no puede escribir
+    with get_cursor() as cur:
+        cur.execute("""
+            UPDATE broadcast_shards s SET status = 'processing', heartbeat_at = NOW(), owner = %s
+            FROM broadcast_queue q
+            WHERE (s.job_id, s.shard) = (
+                SELECT job_id, shard FROM broadcast_shards WHERE status = 'pending'
+                ORDER BY job_id, shard LIMIT 1 FOR UPDATE SKIP LOCKED
+            ) AND q.id = s.job_id
+            RETURNING s.job_id, s.shard, s.shard_count, s.last_user_id, s.stats, q.message, s.owner
+        """, (uuid.uuid4().hex,))
+        return cur.fetchone()
+
+def heartbeat_shard(job_id, shard, owner):
+    # False si el shard ya no es nuestro (recuperado por otro proceso)
+    with get_cursor() as cur:
+        cur.execute("UPDATE broadcast_shards SET heartbeat_at = NOW() WHERE job_id = %s AND shard = %s AND owner = %s AND status = 'processing'",
+                    (job_id, shard, owner))
+        return cur.rowcount > 0
+
+def checkpoint_shard(job_id, shard, owner, last_user_id, stats, dead=()):
+    with get_cursor() as cur:
+        # Chats que bloquearon el bot o ya no existen: un solo UPDATE por bloque, en la misma transacción
+        if dead: cur.execute("UPDATE users SET status = 'blocked' WHERE user_id = ANY(%s) AND status = 'active'", (list(dead),))
+        cur.execute("UPDATE broadcast_shards SET last_user_id = %s, stats = %s, heartbeat_at = NOW() WHERE job_id = %s AND shard = %s AND owner = %s AND status = 'processing'",
+                    (last_user_id, Json(dict(stats)), job_id, shard, owner))
+        owned = cur.rowcount > 0
+        cur.execute("DELETE FROM broadcast_rate WHERE slot < EXTRACT(EPOCH FROM NOW()) - 60")
+        return owned
+
+def finish_shard(job_id, shard, owner, last_user_id, stats):
+    # Devuelve (totales, por shard, duración) si este era el último shard del trabajo
+    with get_cursor() as cur:
+        # Bloquear el trabajo: dos shards que terminan a la vez no pueden ver ambos al otro pendiente
+        cur.execute("SELECT 1 FROM broadcast_queue WHERE id = %s FOR UPDATE", (job_id,))
+        cur.execute("UPDATE broadcast_shards SET status = 'done', last_user_id = %s, stats = %s, heartbeat_at = NOW() WHERE job_id = %s AND shard = %s AND owner = %s AND status = 'processing'",
+                    (last_user_id, Json(dict(stats)), job_id, shard, owner))
+        if cur.rowcount == 0:
+            logging.warning(f"⚠️ Trabajo #{job_id} shard {shard}: ya no es de este proceso, no se cierra")
+            return None
+        cur.execute("SELECT shard, status, stats FROM broadcast_shards WHERE job_id = %s ORDER BY shard", (job_id,))
+        shards = cur.fetchall()
+        if any(status != 'done' for _, status, _ in shards): return None
+        total = Counter()
+        for _, _, shard_stats in shards: total.update(shard_stats or {})
+        cur.execute("""
+            UPDATE broadcast_queue SET status = 'done', stats = %s, finished_at = NOW()
+            WHERE id = %s AND status = 'processing'
+            RETURNING EXTRACT(EPOCH FROM finished_at - created_at)
+        """, (Json(dict(total)), job_id))
+        row = cur.fetchone()
+        if not row: return None
+        return total, [(s, Counter(st or {})) for s, _, st in shards], float(row[0] or 0)
+
+class JobListener:
+    # Despierta el bucle con cada NOTIFY; si no hay LISTEN, el timeout hace de sondeo
+    def __init__(self):
+        self.conn = None
+        self.event = asyncio.Event()
+
+    def _connect(self):
+        try:
+            self.conn = connect_listener(BROADCAST_CHANNEL)
+            asyncio.get_running_loop().add_reader(self.conn.fileno(), self._on_ready)
+            logging.info(f"👂 Escuchando canal {BROADCAST_CHANNEL}")
+        except Exception as e:
+            logging.error(f"Error LISTEN (usando sondeo): {e}")
+            self.conn = None
+
+    def _on_ready(self):
+        try:
+            self.conn.poll()
+        except psycopg2.Error:
+            self.close()
+        else:
+            if not self.conn.notifies: return
+            self.conn.notifies.clear()
+        self.event.set()
+
+    async def wait(self, timeout):
+        if self.conn is None: self._connect()
+        try: await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError: pass
+        self.event.clear()
+
+    def close(self):
+        if self.conn is None: return
+        try: asyncio.get_running_loop().remove_reader(self.conn.fileno())
+        except Exception: pass
+        if not self.conn.closed: self.conn.close()
+        self.conn = None
+
+async def send_one(bot, bucket, budget, queue, stats, dead, uid, attempt, message):
+    if budget: await budget.acquire()
+    await bucket.acquire()
+    try:
+        await bot.send_message(chat_id=uid, text=message, parse_mode=ParseMode.HTML, disable_notification=True)
+        stats["enviados"] += 1
+    except RetryAfter as e:
+        bucket.pause(e.retry_after)
+        if budget: await budget.pause(e.retry_after)
+        stats["flood"] += 1
+        if attempt < MAX_RETRIES: queue.put_nowait((uid, attempt + 1))
+        else: stats["fallidos_flood"] += 1
+    except Forbidden:
+        stats["bloqueados"] += 1
+        dead.append(uid)
+    except BadRequest as e:
+        if "chat not found" in str(e).lower():
+            stats["no_encontrados"] += 1
+            dead.append(uid)
+        else: stats["invalidos"] += 1
+    except NetworkError:
+        # Timeouts y errores de red: reintentar más tarde
+        if attempt < MAX_RETRIES: queue.put_nowait((uid, attempt + 1))
+        else: stats["fallidos_red"] += 1
+    except Exception as e:
+        logging.error(f"Error enviando a {uid}: {e}")
+        stats["otros"] += 1
+
+async def dispatch(bot, users, message, bucket, budget=None):
+    # Cubo de tokens del proceso + MAX_IN_FLIGHT envíos simultáneos; los RetryAfter vuelven a la cola
+    queue = asyncio.Queue()
+    for uid in users: queue.put_nowait((uid, 0))
+    stats = Counter()
+    dead = []
+
+    async def sender():
+        while True:
+            try: uid, attempt = queue.get_nowait()
+            except asyncio.QueueEmpty: return
+            await send_one(bot, bucket, budget, queue, stats, dead, uid, attempt, message)
+
+    await asyncio.gather(*(sender() for _ in range(MAX_IN_FLIGHT)))
+    return stats, dead
+
+def format_report(stats, elapsed, shards=None):
+    fallidos = stats["bloqueados"] + stats["no_encontrados"] + stats["invalidos"] + stats["fallidos_red"] + stats["fallidos_flood"] + stats["otros"]
+    text = (
+        f"✅ <b>Worker Finalizado</b>\n\n📨 Enviados: {stats['enviados']}\n❌ Fallidos: {fallidos}\n"
+        f"🚫 Bloqueados: {stats['bloqueados']} | 👻 No encontrados: {stats['no_encontrados']}\n"
+        f"⚠️ Inválidos: {stats['invalidos']} | 🌐 Red: {stats['fallidos_red']} | ❓ Otros: {stats['otros']}\n"
+        f"🐢 Flood control: {stats['flood']} (perdidos: {stats['fallidos_flood']})\n"
+        f"⏱ Duración: {elapsed:.0f}s"
+    )
+    if shards and len(shards) > 1:
+        text += "\n\n🧩 <b>Shards:</b>\n" + "\n".join(f"• #{shard}: {st['enviados']} enviados" for shard, st in shards)
+    return text
+
+async def keep_shard_alive(job_id, shard_no, owner):
+    # Latido independiente de los bloques; termina solo si el shard pasó a otro proceso
+    while True:
+        await asyncio.sleep(HEARTBEAT_EVERY)
+        try:
+            if not await asyncio.to_thread(heartbeat_shard, job_id, shard_no, owner): return
+        except Exception as e: logging.error(f"Error latido trabajo #{job_id} shard {shard_no}: {e}")
+
+async def run_shard(bot, bucket, budget, shard):
+    job_id, shard_no, shard_count, last_user_id, saved_stats, message, owner = shard
+    stats = Counter(saved_stats or {})
+    if last_user_id: logging.info(f"🔁 Reanudando trabajo #{job_id} shard {shard_no}/{shard_count} tras user_id {last_user_id}")
+    else: logging.info(f"🚀 Iniciando trabajo #{job_id} shard {shard_no}/{shard_count}")
+    
+    beat = asyncio.create_task(keep_shard_alive(job_id, shard_no, owner))
+    try:
+        while True:
+            users = get_users_after(last_user_id, shard_no, shard_count)
+            if not users: break
+            sending = asyncio.create_task(dispatch(bot, users, message, bucket, budget))
+            await asyncio.wait({sending, beat}, return_when=asyncio.FIRST_COMPLETED)
+            if not sending.done():
+                # Otro proceso ya reanudó este shard desde el último checkpoint: dejar de enviar
+                sending.cancel()
+                logging.warning(f"⚠️ Trabajo #{job_id} shard {shard_no}: recuperado por otro proceso, se abandona")
+                return
+            chunk_stats, dead = sending.result()
+            stats.update(chunk_stats)
+            last_user_id = users[-1]
+            if not checkpoint_shard(job_id, shard_no, owner, last_user_id, stats, dead):
+                logging.warning(f"⚠️ Trabajo #{job_id} shard {shard_no}: recuperado por otro proceso, se abandona")
+                return
+            logging.info(f"📦 Trabajo #{job_id} shard {shard_no}/{shard_count}: {stats['enviados']} enviados (user_id {last_user_id})")
+    finally: beat.cancel()
+    
+    # Marcar como terminado; el último shard en terminar cierra el trabajo y avisa
+    report = finish_shard(job_id, shard_no, owner, last_user_id, stats)
+    if report:
+        total, per_shard, elapsed = report
+        await bot.send_message(
+            chat_id=ADMIN_ID,
+            text=format_report(total, elapsed, per_shard),
+            parse_mode=ParseMode.HTML
+        )
 
 async def process_queue():
-    bot = Bot(token=TOKEN)
+    # El pool HTTP por defecto de PTB es de 1 conexión: ampliarlo a los envíos simultáneos
+    bot = Bot(token=TOKEN, request=HTTPXRequest(connection_pool_size=MAX_IN_FLIGHT + 2, pool_timeout=10.0))
+    
+    listener = JobListener()
+    budget = SharedBudget(BROADCAST_RATE)
+    # Un solo cubo por proceso: su ráfaga y sus pausas por RetryAfter valen para todos los bloques
+    bucket = TokenBucket(BROADCAST_RATE, BROADCAST_BURST)
     
     while True:
+        shard = None
         try:
-            conn = psycopg2.connect(DATABASE_URL)
-            cur = conn.cursor()
-            
-            # Buscar trabajo pendiente
-            cur.execute("SELECT id, message FROM broadcast_queue WHERE status = 'pending' LIMIT 1")
-            job = cur.fetchone()
-            
-            if job:
-                job_id, message = job
-                logging.info(f"🚀 Iniciando trabajo #{job_id}")
-                
-                # Marcar como procesando
-                cur.execute("UPDATE broadcast_queue SET status = 'processing' WHERE id = %s", (job_id,))
-                conn.commit()
-                
-                users = await get_all_users()
-                enviados = 0
-                fallidos = 0
-                
-                # BATCHING
-                BATCH = 25
-                for i in range(0, len(users), BATCH):
-                    batch = users[i:i+BATCH]
-                    tasks = []
-                    for uid in batch:
-                        tasks.append(
-                            bot.send_message(chat_id=uid, text=message, parse_mode=ParseMode.HTML, disable_notification=True)
-                        )
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
-                    
-                    for res in results:
-                        if isinstance(res, Exception): fallidos += 1
-                        else: enviados += 1
-                    
-                    await asyncio.sleep(1) # Respetar límites
-                
-                # Marcar como terminado
-                cur.execute("UPDATE broadcast_queue SET status = 'done' WHERE id = %s", (job_id,))
-                conn.commit()
-                
-                # Reporte al Admin
-                await bot.send_message(
-                    chat_id=ADMIN_ID,
-                    text=f"✅ <b>Worker Finalizado</b>\n\n📨 Enviados: {enviados}\n❌ Fallidos: {fallidos}",
-                    parse_mode=ParseMode.HTML
-                )
-                
-            cur.close()
-            conn.close()
-            
+            # En cada vuelta (NOTIFY o sondeo): shards de procesos caídos, propios o de otra réplica
+            reclaim_stale_jobs()
+            expand_pending_job()
+            shard = claim_shard()
+            if shard: await run_shard(bot, bucket, budget, shard)
         except Exception as e:
             logging.error(f"Error worker loop: {e}")
+            await asyncio.sleep(5)
             
-        await asyncio.sleep(5) # Descansar 5 segundos antes de buscar de nuevo
+        # Tras un shard, buscar el siguiente enseguida; si no, esperar NOTIFY (o el sondeo)
+        if not shard: await listener.wait(POLL_FALLBACK)
+
+def run_worker():
+    try: asyncio.run(process_queue())
+    finally: close_pool()
 
 if __name__ == "__main__":
-    logging.info("👷 Worker iniciado...")
-    asyncio.run(process_queue())
+    logging.info(f"👷 Worker iniciado ({WORKER_PROCESSES} proceso/s, {BROADCAST_SHARDS} shards por trabajo)...")
+    if WORKER_PROCESSES > 1:
+        # spawn: cada proceso abre su propio pool, sesión HTTP y LISTEN
+        ctx = multiprocessing.get_context("spawn")
+        procs = [ctx.Process(target=run_worker, name=f"worker-{i}") for i in range(WORKER_PROCESSES)]
+        for p in procs: p.start()
+        for p in procs: p.join()
+    else:
+        run_worker()